@@ -0,0 +1,117 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Runs the Veta manager offline, against the fake snapshot driver and in
+simulated time, for the benchmarks and tools in this directory.
+"""
+
+import datetime
+import os
+import sys
+
+# Use the veta tree this script is part of.
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(__file__),
+                                                 os.pardir)))
+
+from nova import context as novacontext
+from nova import utils as novautils
+from nova.compute import power_state
+from nova.compute import vm_states
+from nova.openstack.common import timeutils
+
+from oslo.config import cfg
+
+from veta import manager
+from veta import meta
+
+CONF = cfg.CONF
+
+class Simulation(object):
+    """ A Veta manager with in-memory instances and backups. Time only
+        passes when the simulation is stepped. """
+
+    def __init__(self, start, overrides=None):
+        CONF.set_override('veta_snapshot_driver',
+                          'fakedriver.FakeSnapshotDriver')
+        # The index is populated directly, never from the database, and
+        # there are no compute nodes to check the load of.
+        CONF.set_override('veta_notifications', True)
+        CONF.set_override('veta_reconcile_frequency', sys.maxint)
+        CONF.set_override('veta_defer_slack', 0)
+        for (name, value) in (overrides or {}).items():
+            CONF.set_override(name, value)
+
+        timeutils.set_time_override(start)
+        self.now = start
+        self.context = novacontext.RequestContext('veta', 'veta',
+                                                  is_admin=True)
+        self.manager = manager.VetaManager()
+        self.driver = self.manager.driver
+        self.instances = {}
+        self.manager._index.reconcile([], start)
+
+    def add_instance(self, instance_uuid, project_id='veta', **kwargs):
+        instance = {
+            'uuid' : instance_uuid,
+            'display_name' : instance_uuid[:8],
+            'project_id' : project_id,
+            'user_id' : 'veta',
+            'host' : None,
+            'vm_state' : vm_states.ACTIVE,
+            'power_state' : power_state.RUNNING,
+            'task_state' : None,
+            'created_at' : self.now,
+            'launched_at' : self.now,
+            'updated_at' : self.now,
+            'metadata' : { meta.BACKUP_ACTIVE_KEY : 'True' }
+        }
+        instance.update(kwargs)
+        self.instances[instance_uuid] = instance
+        self.manager._index.reconcile(self.instances.values(), self.now)
+        return instance
+
+    def act(self, instance_uuid, **fields):
+        """ Takes an action on the instance (starting or stopping it, say),
+            which sets the given fields """
+        self.instances[instance_uuid].update(fields)
+        self.driver.actions.setdefault(instance_uuid, []).append(self.now)
+        self.manager._index.touch(instance_uuid)
+
+    def add_schedule(self, instance_uuid, frequency, retention):
+        (schedule, __, __) = self.driver.instance_backup_schedule_get(
+            self.context, instance_uuid)
+        schedule = schedule + [{ meta.SCHEDULE_ID_KEY :
+                                     novautils.generate_uid('b'),
+                                 meta.SCHEDULE_FREQUENCY_KEY : frequency,
+                                 meta.SCHEDULE_RETENTION_KEY : retention,
+                                 meta.SCHEDULE_ACTIVE_KEY : 1 }]
+        self.driver.instance_backup_schedule_update(self.context,
+                                                    instance_uuid, schedule)
+        self.manager._index.touch(instance_uuid)
+
+    def advance(self, seconds):
+        self.now += datetime.timedelta(seconds=seconds)
+        timeutils.set_time_override(self.now)
+
+    def run_backups(self):
+        self.manager._run_backups(self.context)
+
+    def run_prunes(self):
+        self.manager._run_prunes(self.context)
+
+    def stored(self):
+        """ Returns the number of backups currently stored """
+        return len(self.driver.backups)
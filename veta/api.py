@@ -22,12 +22,31 @@ from nova import utils as novautils
 from nova.db import base
 from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
+from nova.openstack.common.gettextutils import _
+
+from oslo.config import cfg
 
 from . import driver
 from . import meta
+from . import rpcapi
 from . import utils
 
 LOG = logging.getLogger('nova.veta.api')
+CONF = cfg.CONF
+
+api_opts = [
+                cfg.IntOpt('veta_schedule_update_retries',
+                default=5,
+                help='The number of times a backup schedule update is'
+                     ' retried when it conflicts with a concurrent update'
+                     ' of the same schedule.')]
+CONF.register_opts(api_opts)
+
+# Actions supported by backup_schedule_bulk
+BULK_ACTIONS = ('add', 'update', 'enable', 'disable', 'delete')
+
+# Upper bound on the number of instances in a single bulk request
+MAX_BULK_INSTANCES = 1000
 
 class API(base.Base):
     """API for interacting with the Veta backup manager."""
@@ -36,11 +55,27 @@ class API(base.Base):
     def __init__(self, **kwargs):
         super(API, self).__init__(**kwargs)
         self.driver = driver.load_snapshot_driver()
+        self.veta_rpcapi = rpcapi.VetaAPI()
 
     def backup_schedule_list(self, context, instance_uuid):
         return self.driver.instance_backup_schedule(context, instance_uuid)
 
-    def backup_schedule_add(self, context, instance_uuid, params):
+    def backup_schedule_etag(self, context, instance_uuid):
+        """ Returns an entity tag for the instance's backup schedule """
+        (version, __) = self.driver.instance_backup_versions(context,
+                                                             instance_uuid)
+        return "s%s" % version
+
+    def backup_list_etag(self, context, instance_uuid, params):
+        """ Returns an entity tag for the listing of the instance's backups
+            with the given parameters. The backups digest is refreshed by
+            the manager whenever it sees the backups change, including as
+            snapshots complete or fail. """
+        (version, digest) = self.driver.instance_backup_versions(context,
+                                                                 instance_uuid)
+        return "b%s-%s-%s" % (version, digest, utils.params_digest(params))
+
+    def _schedule_params(self, params):
         if not 'frequency' in params:
             raise exception.NovaException(
                 "Backup schedule is missing 'frequency'")
@@ -55,8 +90,35 @@ class API(base.Base):
             raise exception.NovaException(
                 "Invalid backup schedule: retention < frequency")
 
-        schedule = self.driver.instance_backup_schedule(context, instance_uuid)
+        # Optional schedule item keys, given values of None are cleared
+        # and missing ones left alone.
+        options = {}
+        if 'only_changed' in params:
+            only_changed = utils.is_true(params['only_changed'])
+            options[meta.SCHEDULE_ONLY_CHANGED_KEY] = only_changed and 1 \
+                                                          or None
+        if 'tolerance' in params:
+            tolerance = params['tolerance']
+            if tolerance is not None:
+                tolerance = int(tolerance)
+                if tolerance < 0 or tolerance >= frequency:
+                    raise exception.NovaException(
+                        "Invalid backup schedule: tolerance must be "
+                        "between 0 and frequency")
+            options[meta.SCHEDULE_TOLERANCE_KEY] = tolerance
 
+        return (frequency, retention, options)
+
+    def _schedule_ids_param(self, params):
+        if 'schedule_ids' in params:
+            return list(params['schedule_ids'])
+        if not 'schedule_id' in params:
+            raise exception.NovaException(
+                "Backup schedule is missing")
+        return [params['schedule_id']]
+
+    def _schedule_add(self, schedule, frequency, retention,
+                      options=None):
         # Make sure we're not already full
         if len(schedule) >= meta.MAX_SCHEDULE_ITEMS:
             raise exception.NovaException(
@@ -76,31 +138,14 @@ class API(base.Base):
                      meta.SCHEDULE_FREQUENCY_KEY : frequency,
                      meta.SCHEDULE_RETENTION_KEY : retention,
                      meta.SCHEDULE_ACTIVE_KEY : 1 }
+        for (key, value) in (options or {}).items():
+            if value is not None:
+                new_item[key] = value
         schedule.append(new_item)
-        return self.driver.instance_backup_schedule_update(context,
-                                                           instance_uuid,
-                                                           schedule)
-
-    def backup_schedule_update(self, context, instance_uuid, params):
-        if not 'schedule_id' in params:
-            raise exception.NovaException(
-                "Backup schedule is missing")
-        if not 'frequency' in params:
-            raise exception.NovaException(
-                "Backup schedule is missing 'frequency'")
-        if not 'retention' in params:
-            raise exception.NovaException(
-                "Backup schedule is missing 'retention'")
-
-        schedule_id = params['schedule_id']
-        frequency = int(params['frequency'])
-        retention = int(params['retention'])
+        self._schedule_check_length(schedule)
 
-        if retention < frequency:
-            raise exception.NovaException(
-                "Invalid backup schedule: retention < frequency")
-
-        schedule = self.driver.instance_backup_schedule(context, instance_uuid)
+    def _schedule_update(self, schedule, schedule_id, frequency, retention,
+                         options=None):
         # Make sure we don't have any conflicts
         conflict = utils.schedule_has_conflict(schedule, frequency, retention)
         if conflict and conflict[meta.SCHEDULE_ID_KEY] != schedule_id:
@@ -114,25 +159,101 @@ class API(base.Base):
                 schedule_id)
         item[meta.SCHEDULE_FREQUENCY_KEY] = frequency
         item[meta.SCHEDULE_RETENTION_KEY] = retention
-        return self.driver.instance_backup_schedule_update(context,
-                                                           instance_uuid,
-                                                           schedule)
+        for (key, value) in (options or {}).items():
+            if value is None:
+                item.pop(key, None)
+            else:
+                item[key] = value
+        self._schedule_check_length(schedule)
 
-    def backup_schedule_del(self, context, instance_uuid, params):
-        if not 'schedule_id' in params:
+    def _schedule_check_length(self, schedule):
+        # Make sure the schedule still fits in its metadata value
+        if len(utils.schedule_dumps(schedule)) > meta.MAX_SCHEDULE_LENGTH:
             raise exception.NovaException(
-                "Backup schedule is missing")
-        schedule_id = params['schedule_id']
-        schedule = self.driver.instance_backup_schedule(context, instance_uuid)
+                "Backup schedule too long, remove schedules or their "
+                "options")
+
+    def _schedule_del(self, schedule, schedule_id):
         item = utils.find_schedule_item(schedule, schedule_id)
         if item:
             schedule.remove(item)
         else:
             raise exception.NovaException("Backup schedule not found: %s" % \
                 schedule_id)
-        return self.driver.instance_backup_schedule_update(context,
-                                                           instance_uuid,
-                                                           schedule)
+
+    def _schedule_set_active(self, schedule, schedule_id, active):
+        item = utils.find_schedule_item(schedule, schedule_id)
+        if item:
+            item[meta.SCHEDULE_ACTIVE_KEY] = active
+        else:
+            raise exception.NovaException("Backup schedule not found: %s" % \
+                schedule_id)
+
+    def _notify_manager(self, context, instance_uuids):
+        """ Lets the manager know about schedule changes, so that its next
+            backup pass evaluates the instances """
+        if not instance_uuids:
+            return
+        try:
+            self.veta_rpcapi.schedules_changed(context, instance_uuids)
+        except:
+            # The manager will pick up the change eventually anyway.
+            LOG.exception(_("Unable to notify the veta manager of schedule "
+                            "changes for %s") % instance_uuids)
+
+    def _owned_schedule(self, context, instance_uuid):
+        """ Returns the instance's own schedule and its version, refusing
+            instances whose schedule is managed by a policy """
+        (schedule, version, policy_id) = \
+            self.driver.instance_backup_schedule_get(context, instance_uuid)
+        if policy_id:
+            raise exception.NovaException(
+                "Backup schedule is managed by policy %s" % policy_id)
+        return (schedule, version)
+
+    def _update_schedule(self, context, instance_uuid, mutate):
+        """ Applies mutate to the instance's schedule and writes it back,
+            provided nobody else updated the schedule in the meantime.
+            Conflicting updates are retried against the fresh schedule. """
+        for attempt in range(CONF.veta_schedule_update_retries + 1):
+            (schedule, version) = self._owned_schedule(context, instance_uuid)
+            mutate(schedule)
+            try:
+                schedule = self.driver.instance_backup_schedule_update(
+                    context, instance_uuid, schedule, version)
+            except driver.ScheduleVersionConflict:
+                LOG.debug(_("Concurrent update of backup schedule for %s, "
+                            "retrying") % instance_uuid)
+                continue
+            self._notify_manager(context, [instance_uuid])
+            return schedule
+        raise exception.NovaException(
+            "Backup schedule was concurrently modified, please retry")
+
+    def backup_schedule_add(self, context, instance_uuid, params):
+        (frequency, retention, options) = self._schedule_params(params)
+        return self._update_schedule(context, instance_uuid,
+            lambda schedule: \
+                self._schedule_add(schedule, frequency, retention, options))
+
+    def backup_schedule_update(self, context, instance_uuid, params):
+        if not 'schedule_id' in params:
+            raise exception.NovaException(
+                "Backup schedule is missing")
+        schedule_id = params['schedule_id']
+        (frequency, retention, options) = self._schedule_params(params)
+        return self._update_schedule(context, instance_uuid,
+            lambda schedule: \
+                self._schedule_update(schedule, schedule_id,
+                                      frequency, retention, options))
+
+    def backup_schedule_del(self, context, instance_uuid, params):
+        if not 'schedule_id' in params:
+            raise exception.NovaException(
+                "Backup schedule is missing")
+        schedule_id = params['schedule_id']
+        return self._update_schedule(context, instance_uuid,
+            lambda schedule: self._schedule_del(schedule, schedule_id))
 
     def backup_schedule_set_active(self, context, instance_uuid, params):
         if not 'schedule_id' in params:
@@ -141,21 +262,108 @@ class API(base.Base):
             raise exception.NovaException("Missing argument 'active'")
         schedule_id = params['schedule_id']
         active = int(params['active'])
-        schedule = self.driver.instance_backup_schedule(context, instance_uuid)
-        item = utils.find_schedule_item(schedule, schedule_id)
-        if item:
-            item[meta.SCHEDULE_ACTIVE_KEY] = active
-        else:
-            raise exception.NovaException("Backup schedule not found: %s" % \
-                schedule_id)
-        return self.driver.instance_backup_schedule_update(context,
-                                                           instance_uuid,
-                                                           schedule)
+        return self._update_schedule(context, instance_uuid,
+            lambda schedule: \
+                self._schedule_set_active(schedule, schedule_id, active))
+
+    def _bulk_mutation(self, action, params):
+        """ Validates the parameters for a bulk action once, and returns
+            a function applying the action to a single schedule list. """
+        if action == 'add':
+            (frequency, retention, options) = \
+                self._schedule_params(params)
+            return lambda schedule: \
+                self._schedule_add(schedule, frequency, retention, options)
+        elif action == 'update':
+            if not 'schedule_id' in params:
+                raise exception.NovaException(
+                    "Backup schedule is missing")
+            schedule_id = params['schedule_id']
+            (frequency, retention, options) = \
+                self._schedule_params(params)
+            return lambda schedule: \
+                self._schedule_update(schedule, schedule_id,
+                                      frequency, retention, options)
+        elif action in ('enable', 'disable'):
+            schedule_ids = self._schedule_ids_param(params)
+            active = (action == 'enable') and 1 or 0
+            def set_active(schedule):
+                for schedule_id in schedule_ids:
+                    self._schedule_set_active(schedule, schedule_id, active)
+            return set_active
+        elif action == 'delete':
+            schedule_ids = self._schedule_ids_param(params)
+            def delete(schedule):
+                for schedule_id in schedule_ids:
+                    self._schedule_del(schedule, schedule_id)
+            return delete
+        raise exception.NovaException(
+            "Invalid bulk action '%s', must be one of %s" % \
+                (action, ", ".join(BULK_ACTIONS)))
+
+    def backup_schedule_bulk(self, context, params):
+        """ Applies a single schedule action to many instances.
+
+            The parameters are validated once, the resulting schedules are
+            written in a single transaction and a result is returned for
+            each instance, either its new schedule or an error message.
+        """
+        instance_uuids = params.get('instances')
+        if not instance_uuids:
+            raise exception.NovaException("Missing argument 'instances'")
+        if len(instance_uuids) > MAX_BULK_INSTANCES:
+            raise exception.NovaException(
+                "Too many instances (maximum is %d)" % MAX_BULK_INSTANCES)
+        mutate = self._bulk_mutation(params.get('action'),
+                                     params.get('params', {}))
+
+        # Only touch instances visible in this context. For non-admin
+        # contexts the lookup is restricted to the project's instances.
+        filters = { 'uuid' : list(instance_uuids) }
+        visible = set(instance['uuid'] for instance in \
+                      self.db.instance_get_all_by_filters(context, filters))
+
+        results = {}
+        pending = []
+        for instance_uuid in instance_uuids:
+            if instance_uuid in visible:
+                pending.append(instance_uuid)
+            else:
+                results[instance_uuid] = {
+                    'error' : "Instance not found: %s" % instance_uuid }
+
+        # Instances whose schedule was concurrently modified are retried
+        # against their fresh schedule.
+        for attempt in range(CONF.veta_schedule_update_retries + 1):
+            schedules = {}
+            for instance_uuid in pending:
+                try:
+                    (schedule, version) = self._owned_schedule(context,
+                                                               instance_uuid)
+                    mutate(schedule)
+                except exception.NovaException as error:
+                    results[instance_uuid] = { 'error' : unicode(error) }
+                    continue
+                schedules[instance_uuid] = (schedule, version)
+
+            (updated, pending) = \
+                self.driver.instance_backup_schedules_update(context,
+                                                             schedules)
+            for (instance_uuid, schedule) in updated.items():
+                results[instance_uuid] = { 'schedule' : schedule }
+            self._notify_manager(context, updated.keys())
+            if not pending:
+                break
+
+        for instance_uuid in pending:
+            results[instance_uuid] = {
+                'error' : "Backup schedule was concurrently modified" }
+        return results
 
     def backup_schedule_clear(self, context, instance_uuid):
-        return self.driver.instance_backup_schedule_update(context,
-                                                           instance_uuid,
-                                                           None)
+        def clear(schedule):
+            del schedule[:]
+        return self._update_schedule(context, instance_uuid, clear)
 
     def backup_schedule_list_backups(self, context, instance_uuid, params):
         schedule_id = params.get('schedule_id')
@@ -166,5 +374,156 @@ class API(base.Base):
             if not item:
                 raise exception.NovaException(
                     "Backup schedule not found: %s" % schedule_id)
-        return self.driver.instance_backups(context, instance_uuid,
-                                            schedule_id)
+        backups = self.driver.instance_backups_iter(context, instance_uuid,
+                                                    schedule_id)
+
+        # Summary mode returns aggregate figures rather than the backups
+        if utils.is_true(params.get('summary')):
+            return self._summarize_backups(backups)
+
+        fields = params.get('fields')
+        if fields:
+            if isinstance(fields, basestring):
+                fields = fields.split(',')
+            return (utils.project_backup(backup, fields) \
+                    for backup in backups)
+        return backups
+
+    def _summarize_backups(self, backups):
+        """ Returns the number of backups, the timestamps of the oldest and
+            newest ones, and the number of backups for each schedule """
+        count = 0
+        oldest = None
+        newest = None
+        schedules = {}
+        for backup in backups:
+            count += 1
+            backup_at = backup[meta.BACKUP_AT_KEY]
+            # Timestamps sort lexically (see timeutils.strtime)
+            if oldest is None or backup_at < oldest:
+                oldest = backup_at
+            if newest is None or backup_at > newest:
+                newest = backup_at
+            for schedule_id in jsonutils.loads(
+                    backup.get(meta.BACKUP_SATISFIES_KEY, '[]')):
+                schedules[schedule_id] = schedules.get(schedule_id, 0) + 1
+        return { 'count' : count,
+                 'oldest' : oldest,
+                 'newest' : newest,
+                 'schedules' : schedules }
+
+    def backup_schedule_set_policy(self, context, instance_uuid, params):
+        """ Makes the instance use the given shared backup policy, or, if no
+            policy is given, detaches it from its current policy. A detached
+            instance keeps a private copy of the policy's schedule, so that
+            its existing backups are retained. """
+        policy_id = params.get('policy_id')
+        if policy_id:
+            if policy_id not in self.driver.policy_list(context):
+                raise exception.NovaException(
+                    "Backup policy not found: %s" % policy_id)
+            self.driver.instance_backup_policy_update(context, instance_uuid,
+                                                      policy_id)
+        else:
+            schedule = self.driver.instance_backup_schedule(context,
+                                                            instance_uuid)
+            self.driver.instance_backup_policy_update(context, instance_uuid,
+                                                      None, schedule)
+        self._notify_manager(context, [instance_uuid])
+        return self.driver.instance_backup_schedule(context, instance_uuid)
+
+    def _policy_schedule(self, params):
+        items = params.get('schedule')
+        if not items:
+            raise exception.NovaException(
+                "Backup policy is missing 'schedule'")
+        schedule = []
+        for item in items:
+            (frequency, retention, options) = self._schedule_params(item)
+            self._schedule_add(schedule, frequency, retention, options)
+        return schedule
+
+    def backup_policy_list(self, context):
+        return self.driver.policy_list(context).values()
+
+    def backup_policy_create(self, context, params):
+        if not context.is_admin:
+            raise exception.AdminRequired()
+        if not 'name' in params:
+            raise exception.NovaException("Backup policy is missing 'name'")
+        schedule = self._policy_schedule(params)
+        policy_id = novautils.generate_uid('p')
+        return self.driver.policy_update(context, policy_id,
+                                         params['name'], schedule)
+
+    def backup_policy_update(self, context, policy_id, params):
+        """ Updates a backup policy. Schedule items keep the IDs of the
+            items they replace, so that backups taken under the previous
+            version of the policy are retained. """
+        if not context.is_admin:
+            raise exception.AdminRequired()
+        policy = self.driver.policy_list(context).get(policy_id)
+        if not policy:
+            raise exception.NovaException(
+                "Backup policy not found: %s" % policy_id)
+        name = params.get('name', policy[meta.POLICY_NAME_KEY])
+        schedule = policy[meta.POLICY_SCHEDULE_KEY]
+        if 'schedule' in params:
+            old_schedule = schedule
+            schedule = self._policy_schedule(params)
+            self._policy_schedule_keep_ids(old_schedule, params['schedule'],
+                                           schedule)
+        policy = self.driver.policy_update(context, policy_id, name,
+                                           schedule)
+        # The schedules of every instance using the policy changed.
+        self._notify_manager(context,
+                             self._policy_instances(context, policy_id))
+        return policy
+
+    def _policy_schedule_keep_ids(self, old_schedule, items, schedule):
+        """ Gives the items of the new schedule of a policy (built from
+            the given request items) the IDs of the items they replace:
+            those given as their schedule_id, or else those at the same
+            position in the old schedule. """
+        named = set(item['schedule_id'] for item in items \
+                    if 'schedule_id' in item)
+        for (i, (item, new_item)) in enumerate(zip(items, schedule)):
+            if 'schedule_id' in item:
+                old_item = utils.find_schedule_item(old_schedule,
+                                                    item['schedule_id'])
+                if not old_item:
+                    raise exception.NovaException(
+                        "Backup schedule not found: %s" % \
+                            item['schedule_id'])
+            elif i < len(old_schedule) and \
+                    old_schedule[i][meta.SCHEDULE_ID_KEY] not in named:
+                old_item = old_schedule[i]
+            else:
+                continue
+            new_item[meta.SCHEDULE_ID_KEY] = old_item[meta.SCHEDULE_ID_KEY]
+            new_item[meta.SCHEDULE_ACTIVE_KEY] = \
+                old_item[meta.SCHEDULE_ACTIVE_KEY]
+
+        schedule_ids = [item[meta.SCHEDULE_ID_KEY] for item in schedule]
+        if len(set(schedule_ids)) != len(schedule_ids):
+            raise exception.NovaException(
+                "Backup policy schedule replaces an item more than once")
+
+    def _policy_instances(self, context, policy_id):
+        """ Returns the UUIDs of the instances using the backup policy """
+        filters = { 'metadata' : { meta.BACKUP_POLICY_KEY : policy_id } }
+        return [instance['uuid'] for instance in \
+                self.db.instance_get_all_by_filters(context, filters)]
+
+    def backup_policy_delete(self, context, policy_id):
+        if not context.is_admin:
+            raise exception.AdminRequired()
+        if policy_id not in self.driver.policy_list(context):
+            raise exception.NovaException(
+                "Backup policy not found: %s" % policy_id)
+        # Deleting a policy in use would silently drop the backups of
+        # every instance referencing it.
+        if self._policy_instances(context, policy_id):
+            raise exception.NovaException(
+                "Backup policy %s is still in use" % policy_id)
+        self.driver.policy_delete(context, policy_id)
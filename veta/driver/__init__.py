@@ -21,6 +21,7 @@ from nova.openstack.common import importutils
 from nova.openstack.common import log as logging
 from nova.openstack.common.gettextutils import _
 
+from nova import exception
 from nova import utils
 
 driver_opts = [
@@ -28,39 +29,176 @@ driver_opts = [
                default='novadriver.NovaSnapshotDriver',
                help='Driver to use for taking snapshots. Options '
                     'include: novadriver.NovaSnapshotDriver, '
-                    'cobaltdriver.CobaltSnapshotDriver.')
+                    'cobaltdriver.CobaltSnapshotDriver.'),
+    cfg.IntOpt('veta_snapshot_concurrency',
+               default=10,
+               help='The maximum number of snapshots a driver creates '
+                    'in parallel when creating several at once.'),
+    cfg.IntOpt('veta_backup_page_size',
+               default=100,
+               help='The number of backups fetched at a time when '
+                    'listing the backups of an instance.')
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(driver_opts)
 LOG = logging.getLogger('nova')
 
+class ScheduleVersionConflict(exception.NovaException):
+    message = _("Backup schedule for instance %(instance_uuid)s was "
+                "concurrently modified")
+
+def iter_pages(fetch_page, page_size, marker_key):
+    """ Iterates over the items of the pages returned by fetch_page, given
+        the marker of the last item of the previous page (or None).
+
+        Each page is fetched before the items of the previous one are
+        returned, so that the caller may delete items as it goes without
+        invalidating the marker. At most two pages are held at a time. """
+    page = fetch_page(None)
+    while page:
+        if len(page) < page_size:
+            next_page = []
+        else:
+            next_page = fetch_page(page[-1][marker_key])
+        for item in page:
+            yield item
+        page = next_page
+
 # Snapshot driver interface
 class SnapshotDriver(object):
-    def instance_backup_schedule(self, context, instance_uuid):
-        ''' Get instance backup schedules. '''
+    def instance_backup_schedule(self, context, instance_uuid,
+                                 policies=None):
+        ''' Get instance backup schedules. If the instance references a
+            backup policy, the policy's schedules are returned, resolved
+            from the given policies (as returned by policy_list) if
+            provided. '''
+        pass
+
+    def instance_backup_schedule_get(self, context, instance_uuid):
+        ''' Get the instance's own backup schedules, their version and
+            the ID of the backup policy the instance references (or
+            None), as a tuple. '''
         pass
 
     def instance_backup_schedule_update(self, context, instance_uuid,
-                                         schedule):
-        ''' Update instance backup schedules. '''
+                                         schedule, version=None):
+        ''' Update instance backup schedules. If a version is given, the
+            update only succeeds if the schedules are still at that
+            version, and raises ScheduleVersionConflict otherwise. '''
+        pass
+
+    def instance_backup_schedules_update(self, context, schedules):
+        ''' Update the backup schedules of several instances, given
+            as a dictionary of instance UUID to (schedule, version).
+            Returns a dictionary of instance UUID to updated schedule,
+            and the list of instance UUIDs whose update conflicted. '''
+        updated = {}
+        conflicts = []
+        for (instance_uuid, (schedule, version)) in schedules.items():
+            try:
+                updated[instance_uuid] = \
+                    self.instance_backup_schedule_update(context,
+                                                         instance_uuid,
+                                                         schedule, version)
+            except ScheduleVersionConflict:
+                conflicts.append(instance_uuid)
+        return (updated, conflicts)
+
+    def instance_backup_policy_update(self, context, instance_uuid,
+                                      policy_id, schedule=None):
+        ''' Set (or, given None, clear) the backup policy referenced by
+            the instance, optionally replacing its own schedules. '''
+        pass
+
+    def policy_list(self, context):
+        ''' Get all backup policies, as a dictionary of policy ID to
+            policy. '''
+        pass
+
+    def policy_update(self, context, policy_id, name, schedule):
+        ''' Create or update a backup policy. '''
+        pass
+
+    def policy_delete(self, context, policy_id):
+        ''' Delete a backup policy. '''
+        pass
+
+    def instance_backup_versions(self, context, instance_uuid):
+        ''' Get the version of the instance's effective backup schedule
+            and the digest of its backups, as opaque strings. This should
+            be much cheaper than fetching either of them. '''
+        pass
+
+    def instance_backup_schedule_changed_at(self, context, instance_uuid):
+        ''' Get when the instance's effective backup schedule last
+            changed, or None if that isn't known. '''
+        pass
+
+    def instance_backups_digest_update(self, context, instance_uuid,
+                                       digest):
+        ''' Record the digest of the instance's backups. '''
+        pass
+
+    def instance_acted_on_since(self, context, instance_uuid, since):
+        ''' Get whether any action that may have changed the instance
+            (starting, resuming, rebuilding...) was taken on it since the
+            given time. Snapshots don't count. '''
         pass
 
     def instance_backups(self, context, instance_id,
                          schedule_id=None):
         ''' List instance backups, optionally filtering by
             schedule ID. '''
+        return list(self.instance_backups_iter(context, instance_id,
+                                               schedule_id))
+
+    def instance_backups_iter(self, context, instance_id,
+                              schedule_id=None, newest_first=False):
+        ''' Iterate over instance backups in order of creation,
+            optionally filtering by schedule ID. Backups are fetched
+            a page at a time as the iteration proceeds, and may be
+            discarded once returned. '''
+        pass
+
+    def all_backups_iter(self, context):
+        ''' Iterate over the backups of all instances, including those
+            whose instance no longer exists. Backups may be discarded
+            once returned. '''
         pass
 
     def backup_metadata_update(self, context, backup_uuid, metadata):
         pass
 
     def create_snapshot(self, context, instance, name, metadata=None):
+        ''' Create a snapshot of the instance. If the metadata holds a
+            backup key (meta.BACKUP_KEY_KEY) and the instance already has
+            a backup with that key, no snapshot is created, and that
+            backup is returned instead. '''
         pass
 
+    # Drivers may also implement create_snapshots(context, snapshots),
+    # creating several snapshots at once given a list of (instance, name,
+    # metadata) tuples. It returns the list of backups created, in the
+    # same order, with None for those that could not be created. The
+    # manager falls back to create_snapshot() for drivers without it.
+
     def discard_snapshot(self, context, backup_uuid):
         pass
 
+    def discard_snapshots(self, context, backup_uuids):
+        ''' Discard several snapshots. Returns the UUIDs of those that
+            could not be discarded. '''
+        failed = []
+        for backup_uuid in backup_uuids:
+            try:
+                self.discard_snapshot(context, backup_uuid)
+            except:
+                LOG.exception(_("Cannot discard backup with uuid %s") % \
+                              backup_uuid)
+                failed.append(backup_uuid)
+        return failed
+
 # Load the snapshot driver
 def load_snapshot_driver():
     if not CONF.veta_snapshot_driver:
@@ -15,13 +15,21 @@
 
 from nova import context as novacontext
 from nova import db
+from nova import exception
+from nova.db.sqlalchemy import api as db_api
+from nova.db.sqlalchemy import models
 from nova.openstack.common import jsonutils
 
 from cobalt.nova import api as cobaltapi
 
+from oslo.config import cfg
+
 from . import novadriver
+from .. import driver
 from .. import meta
 
+CONF = cfg.CONF
+
 class CobaltSnapshotDriver(novadriver.NovaSnapshotDriver):
     def __init__(self, **kwargs):
         super(CobaltSnapshotDriver, self).__init__(**kwargs)
@@ -43,34 +51,82 @@ class CobaltSnapshotDriver(novadriver.NovaSnapshotDriver):
             meta.BACKUP_FOR_KEY : metadata[meta.BACKUP_FOR_KEY],
             meta.BACKUP_AT_KEY : metadata[meta.BACKUP_AT_KEY],
             meta.BACKUP_SATISFIES_KEY : metadata.get(
-                meta.BACKUP_SATISFIES_KEY, "[]")
+                meta.BACKUP_SATISFIES_KEY, "[]"),
+            meta.BACKUP_VM_STATE_KEY : metadata.get(
+                meta.BACKUP_VM_STATE_KEY),
+            meta.BACKUP_EXPIRES_AT_KEY : metadata.get(
+                meta.BACKUP_EXPIRES_AT_KEY),
+            meta.BACKUP_EXPIRES_VERSION_KEY : metadata.get(
+                meta.BACKUP_EXPIRES_VERSION_KEY),
+            meta.BACKUP_KEY_KEY : metadata.get(meta.BACKUP_KEY_KEY)
         }
 
-    def instance_backups(self, context, instance_uuid,
-            schedule_id=None):
-        """Get backups for the given instance."""
+    def instance_backups_iter(self, context, instance_uuid,
+                              schedule_id=None, newest_first=False):
+        """Iterate over backups for the given instance."""
         filters = { 'metadata' : { meta.BACKUP_FOR_KEY : instance_uuid } }
-        backups = db.instance_get_all_by_filters(context,
-                                                 filters)
+        sort_dir = newest_first and 'desc' or 'asc'
+        page_size = CONF.veta_backup_page_size
+
+        def fetch_page(marker):
+            return db.instance_get_all_by_filters(context, filters,
+                                                  sort_key='created_at',
+                                                  sort_dir=sort_dir,
+                                                  limit=page_size,
+                                                  marker=marker)
 
-        # Filter for schedule
-        if schedule_id:
-            backups = filter(
-                lambda b: schedule_id in \
-                    self._get_backup_schedules(context, b['uuid']),
-                    backups)
+        for backup in driver.iter_pages(fetch_page, page_size, 'uuid'):
+            # Filter for schedule
+            if schedule_id and schedule_id not in \
+                    self._get_backup_schedules(context, backup['uuid']):
+                continue
+            yield self._get_backup_dict(context, backup)
 
-        # Sort by creation time
-        backups = sorted(backups, key=lambda b: b['created_at'])
+    def all_backups_iter(self, context):
+        """Iterate over the backups of all instances."""
+        # Find the backups from their metadata, rather than scanning all
+        # instances.
+        page_size = CONF.veta_backup_page_size
+        last_id = 0
+        while True:
+            rows = db_api.model_query(context, models.InstanceMetadata,
+                                      read_deleted="no").\
+                        filter_by(key=meta.BACKUP_FOR_KEY).\
+                        filter(models.InstanceMetadata.id > last_id).\
+                        order_by(models.InstanceMetadata.id).\
+                        limit(page_size).all()
+            for row in rows:
+                try:
+                    backup = db.instance_get_by_uuid(context,
+                                                     row['instance_uuid'])
+                except exception.InstanceNotFound:
+                    continue
+                yield self._get_backup_dict(context, backup)
 
-        # Return UUIDs
-        return map(lambda b: self._get_backup_dict(context, b), backups)
+            if len(rows) < page_size:
+                break
+            last_id = rows[-1]['id']
 
     def backup_metadata_update(self, context, backup_uuid, metadata):
         db.instance_metadata_update(context, backup_uuid,
                                     metadata, False)
 
+    def _find_backup(self, context, instance_uuid, key):
+        """ Returns the instance's blessed backup with the given key, if
+            any """
+        filters = { 'metadata' : { meta.BACKUP_FOR_KEY : instance_uuid,
+                                   meta.BACKUP_KEY_KEY : key } }
+        backups = db.instance_get_all_by_filters(context, filters, limit=1)
+        return backups and backups[0] or None
+
     def create_snapshot(self, context, instance, name, metadata=None):
+        # Note that the metadata can only be set once the instance is
+        # blessed, so a backup interrupted in between won't be found.
+        key = (metadata or {}).get(meta.BACKUP_KEY_KEY)
+        backup = key and self._find_backup(context, instance['uuid'], key)
+        if backup:
+            return self._get_backup_dict(context, backup)
+
         backup_context = novacontext.RequestContext(instance['user_id'],
                                                     instance['project_id'])
         backup = self.cobalt.bless_instance(backup_context,
@@ -79,6 +135,9 @@ class CobaltSnapshotDriver(novadriver.NovaSnapshotDriver):
         backup_uuid = backup['uuid']
         db.instance_metadata_update(context, backup_uuid,
                                     metadata, False)
+        return self._get_backup_dict(context,
+                                     db.instance_get_by_uuid(context,
+                                                             backup_uuid))
 
     def discard_snapshot(self, context, backup_uuid):
         backup = db.instance_get_by_uuid(context, backup_uuid)
@@ -0,0 +1,172 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-memory snapshot driver, for simulating the manager offline (e.g. in
+benchmarks). Nothing is stored in Nova or Glance: schedules, policies and
+backups only live as long as the driver.
+"""
+
+from nova.openstack.common import jsonutils
+from nova.openstack.common import timeutils
+from nova.openstack.common import uuidutils
+
+from .. import driver
+from .. import meta
+
+class FakeSnapshotDriver(driver.SnapshotDriver):
+    def __init__(self, **kwargs):
+        super(FakeSnapshotDriver, self).__init__(**kwargs)
+        # Instance UUID to (schedule, version, policy ID)
+        self.schedules = {}
+        # Policy ID to policy, and to policy version
+        self.policies = {}
+        self.policy_versions = {}
+        # Instance or policy ID to when its schedule last changed
+        self.changed_at = {}
+        # Instance UUID to the times actions were taken on it
+        self.actions = {}
+        # Backup UUID to backup, instance UUID to backup UUIDs, and
+        # instance UUID to backups digest
+        self.backups = {}
+        self.instance_backup_uuids = {}
+        self.digests = {}
+        # Counts of snapshots created and discarded
+        self.created = 0
+        self.discarded = 0
+
+    def instance_backup_schedule(self, context, instance_uuid,
+                                 policies=None):
+        (schedule, __, policy_id) = \
+            self.instance_backup_schedule_get(context, instance_uuid)
+        if policy_id:
+            if policies is None:
+                policies = self.policies
+            policy = policies.get(policy_id)
+            if policy:
+                return policy[meta.POLICY_SCHEDULE_KEY]
+        return schedule
+
+    def instance_backup_schedule_get(self, context, instance_uuid):
+        return self.schedules.get(instance_uuid, ([], 0, None))
+
+    def instance_backup_schedule_update(self, context, instance_uuid,
+                                         schedule, version=None):
+        (__, current, policy_id) = \
+            self.instance_backup_schedule_get(context, instance_uuid)
+        if version is not None and version != current:
+            raise driver.ScheduleVersionConflict(instance_uuid=instance_uuid)
+        schedule = sorted(schedule,
+                          key=lambda x: x[meta.SCHEDULE_FREQUENCY_KEY])
+        self.schedules[instance_uuid] = (schedule, current + 1, policy_id)
+        self.changed_at[instance_uuid] = timeutils.utcnow()
+        return schedule
+
+    def instance_backup_policy_update(self, context, instance_uuid,
+                                      policy_id, schedule=None):
+        (old_schedule, version, __) = \
+            self.instance_backup_schedule_get(context, instance_uuid)
+        if schedule is None:
+            schedule = old_schedule
+        self.schedules[instance_uuid] = (schedule, version + 1, policy_id)
+        self.changed_at[instance_uuid] = timeutils.utcnow()
+
+    def policy_list(self, context):
+        return self.policies
+
+    def policy_update(self, context, policy_id, name, schedule):
+        policy = {
+            meta.POLICY_ID_KEY : policy_id,
+            meta.POLICY_NAME_KEY : name,
+            meta.POLICY_SCHEDULE_KEY : schedule
+        }
+        self.policies[policy_id] = policy
+        self.policy_versions[policy_id] = \
+            self.policy_versions.get(policy_id, 0) + 1
+        self.changed_at[policy_id] = timeutils.utcnow()
+        return policy
+
+    def policy_delete(self, context, policy_id):
+        self.policies.pop(policy_id, None)
+
+    def instance_backup_versions(self, context, instance_uuid):
+        (__, version, policy_id) = \
+            self.instance_backup_schedule_get(context, instance_uuid)
+        version = str(version)
+        if policy_id:
+            version = "%s:%s:%s" % (version, policy_id,
+                                    self.policy_versions.get(policy_id, 0))
+        return (version, self.digests.get(instance_uuid, ''))
+
+    def instance_backup_schedule_changed_at(self, context, instance_uuid):
+        (__, __, policy_id) = \
+            self.instance_backup_schedule_get(context, instance_uuid)
+        changed_at = [self.changed_at[key] \
+                      for key in (instance_uuid, policy_id) \
+                      if key in self.changed_at]
+        return changed_at and max(changed_at) or None
+
+    def instance_backups_digest_update(self, context, instance_uuid,
+                                       digest):
+        self.digests[instance_uuid] = digest
+
+    def instance_acted_on_since(self, context, instance_uuid, since):
+        return any(at >= since for at in self.actions.get(instance_uuid, ()))
+
+    def instance_backups_iter(self, context, instance_uuid,
+                              schedule_id=None, newest_first=False):
+        backups = [self.backups[backup_uuid] for backup_uuid in \
+                   self.instance_backup_uuids.get(instance_uuid, ())]
+        backups.sort(key=lambda b: (b[meta.BACKUP_AT_KEY], b['uuid']),
+                     reverse=newest_first)
+        for backup in backups:
+            if schedule_id and schedule_id not in \
+                    jsonutils.loads(backup[meta.BACKUP_SATISFIES_KEY]):
+                continue
+            yield dict(backup)
+
+    def all_backups_iter(self, context):
+        for backup in self.backups.values():
+            yield dict(backup)
+
+    def backup_metadata_update(self, context, backup_uuid, metadata):
+        self.backups[backup_uuid].update(metadata)
+
+    def create_snapshot(self, context, instance, name, metadata=None):
+        key = (metadata or {}).get(meta.BACKUP_KEY_KEY)
+        if key:
+            for backup_uuid in self.instance_backup_uuids.get(
+                    instance['uuid'], ()):
+                if self.backups[backup_uuid].get(meta.BACKUP_KEY_KEY) == key:
+                    return dict(self.backups[backup_uuid])
+
+        backup = {
+            'uuid' : uuidutils.generate_uuid(),
+            'name' : name,
+            'status' : 'active',
+            meta.BACKUP_SATISFIES_KEY : "[]"
+        }
+        backup.update(metadata or {})
+        self.backups[backup['uuid']] = backup
+        self.instance_backup_uuids.setdefault(instance['uuid'],
+                                              set()).add(backup['uuid'])
+        self.created += 1
+        return dict(backup)
+
+    def discard_snapshot(self, context, backup_uuid):
+        backup = self.backups.pop(backup_uuid)
+        self.instance_backup_uuids[backup[meta.BACKUP_FOR_KEY]].discard(
+            backup_uuid)
+        self.discarded += 1
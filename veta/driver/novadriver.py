@@ -13,11 +13,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from eventlet import greenpool
+
 from nova import db
 from nova import context as novacontext
+from nova import exception
 from nova.compute import api as novaapi
+from nova.db.sqlalchemy import api as db_api
+from nova.db.sqlalchemy import models
 from nova.image import glance
 from nova.openstack.common import jsonutils
+from nova.openstack.common import log as logging
+from nova.openstack.common.gettextutils import _
 
 from oslo.config import cfg
 
@@ -25,6 +32,12 @@ from .. import driver
 from .. import meta
 from .. import utils
 
+LOG = logging.getLogger('nova.veta.driver')
+CONF = cfg.CONF
+
+# Instance actions taking snapshots, which newer versions of Nova record
+SNAPSHOT_ACTIONS = ('createImage', 'createBackup')
+
 class NovaSnapshotDriver(driver.SnapshotDriver):
     def __init__(self, **kwargs):
         super(NovaSnapshotDriver, self).__init__(**kwargs)
@@ -40,9 +53,21 @@ class NovaSnapshotDriver(driver.SnapshotDriver):
         return db.instance_metadata_update(context, instance_uuid,
             metadata, False)
 
-    def _instance_backup_schedule(self, context, instance_uuid):
+    def _instance_backup_schedule(self, context, instance_uuid,
+                                  policies=None):
         """ Returns the backup schedule for the given instance uuid """
         metadata = self._instance_metadata(context, instance_uuid)
+        policy_id = metadata.get(meta.BACKUP_POLICY_KEY)
+        if policy_id:
+            if policies is None:
+                policies = self.policy_list(context)
+            policy = policies.get(policy_id)
+            if policy:
+                return policy[meta.POLICY_SCHEDULE_KEY]
+            # Don't drop the instance's backups because of a dangling
+            # reference, use its own schedule instead.
+            LOG.warn(_("Instance %s references missing backup policy %s") % \
+                     (instance_uuid, policy_id))
         return jsonutils.loads(
             metadata.get(meta.BACKUP_SCHEDULE_KEY, "[]"))
 
@@ -61,56 +86,338 @@ class NovaSnapshotDriver(driver.SnapshotDriver):
             meta.BACKUP_FOR_KEY : metadata[meta.BACKUP_FOR_KEY],
             meta.BACKUP_AT_KEY : metadata[meta.BACKUP_AT_KEY],
             meta.BACKUP_SATISFIES_KEY : metadata.get(
-                meta.BACKUP_SATISFIES_KEY, "[]")
+                meta.BACKUP_SATISFIES_KEY, "[]"),
+            meta.BACKUP_VM_STATE_KEY : metadata.get(
+                meta.BACKUP_VM_STATE_KEY),
+            meta.BACKUP_EXPIRES_AT_KEY : metadata.get(
+                meta.BACKUP_EXPIRES_AT_KEY),
+            meta.BACKUP_EXPIRES_VERSION_KEY : metadata.get(
+                meta.BACKUP_EXPIRES_VERSION_KEY),
+            meta.BACKUP_KEY_KEY : metadata.get(meta.BACKUP_KEY_KEY)
         }
 
-    def instance_backup_schedule(self, context, instance_uuid):
-        return self._instance_backup_schedule(context, instance_uuid)
+    def instance_backup_schedule(self, context, instance_uuid,
+                                 policies=None):
+        return self._instance_backup_schedule(context, instance_uuid,
+                                              policies)
 
-    def instance_backup_schedule_update(self, context, instance_uuid,
-                                         schedule):
-        """ Updates the backup schedule for the given instance uuid """
+    def instance_backup_schedule_get(self, context, instance_uuid):
+        """ Returns the instance's own backup schedule, its version and
+            the backup policy it references (if any) """
         metadata = self._instance_metadata(context, instance_uuid)
+        return (jsonutils.loads(metadata.get(meta.BACKUP_SCHEDULE_KEY, "[]")),
+                int(metadata.get(meta.BACKUP_SCHEDULE_VERSION_KEY, 0)),
+                metadata.get(meta.BACKUP_POLICY_KEY) or None)
+
+    def _backup_schedule_metadata(self, schedule):
+        """ Returns the instance metadata and the (sorted) schedule to store
+            for the given backup schedule """
+        metadata = {}
         schedule_key = meta.BACKUP_SCHEDULE_KEY
         active_key = meta.BACKUP_ACTIVE_KEY
         if schedule and len(schedule) > 0:
             # Sort items by frequency
             sorted_schedule = sorted(schedule,
                 key=lambda item: item[meta.SCHEDULE_FREQUENCY_KEY])
-            metadata[schedule_key] = jsonutils.dumps(sorted_schedule)
+            metadata[schedule_key] = utils.schedule_dumps(sorted_schedule)
             metadata[active_key] = True # This lingers forever, on purpose.
-            self._instance_metadata_update(context, instance_uuid, metadata)
-            return sorted_schedule
+            return (metadata, sorted_schedule)
         else:
             metadata[schedule_key] = jsonutils.dumps([])
-            self._instance_metadata_update(context, instance_uuid, metadata)
-        return []
+        return (metadata, [])
+
+    def instance_backup_versions(self, context, instance_uuid):
+        """ Returns the schedule version and backups digest of the given
+            instance, looking up only the relevant metadata keys """
+        keys = (meta.BACKUP_SCHEDULE_VERSION_KEY,
+                meta.BACKUP_POLICY_KEY,
+                meta.BACKUP_DIGEST_KEY)
+        rows = db_api.model_query(context, models.InstanceMetadata,
+                                  read_deleted="no").\
+                    filter_by(instance_uuid=instance_uuid).\
+                    filter(models.InstanceMetadata.key.in_(keys)).all()
+        metadata = dict((row['key'], row['value']) for row in rows)
+
+        version = metadata.get(meta.BACKUP_SCHEDULE_VERSION_KEY, '0')
+        policy_id = metadata.get(meta.BACKUP_POLICY_KEY)
+        if policy_id:
+            # The effective schedule is the policy's.
+            version = "%s:%s:%s" % (version, policy_id,
+                                    self._policy_version(context, policy_id))
+        return (version, metadata.get(meta.BACKUP_DIGEST_KEY, ''))
+
+    def instance_backup_schedule_changed_at(self, context, instance_uuid):
+        """ Returns when the instance's effective schedule last changed,
+            that is when its version (or its policy's) was last bumped """
+        keys = (meta.BACKUP_SCHEDULE_VERSION_KEY, meta.BACKUP_POLICY_KEY)
+        rows = db_api.model_query(context, models.InstanceMetadata,
+                                  read_deleted="no").\
+                    filter_by(instance_uuid=instance_uuid).\
+                    filter(models.InstanceMetadata.key.in_(keys)).all()
+        rows = dict((row['key'], row) for row in rows)
+
+        version_rows = [rows.get(meta.BACKUP_SCHEDULE_VERSION_KEY)]
+        policy_row = rows.get(meta.BACKUP_POLICY_KEY)
+        if policy_row is not None and policy_row['value']:
+            version_rows.append(self._policy_version_row(context,
+                                                         policy_row['value']))
+        changed_at = [row['updated_at'] or row['created_at'] \
+                      for row in version_rows if row is not None]
+        return changed_at and max(changed_at) or None
+
+    def instance_backups_digest_update(self, context, instance_uuid,
+                                       digest):
+        self._instance_metadata_update(context, instance_uuid,
+                                       { meta.BACKUP_DIGEST_KEY : digest })
+
+    def instance_acted_on_since(self, context, instance_uuid, since):
+        """ Returns whether an action was taken on the instance since the
+            given time, as recorded by Nova (newest first) """
+        for action in db.actions_get(context, instance_uuid):
+            if action['start_time'] < since:
+                break
+            if action['action'] not in SNAPSHOT_ACTIONS:
+                return True
+        return False
+
+    def _backup_schedule_bump_version(self, context, instance_uuid,
+                                      version, session):
+        """ Bumps the schedule version of the given instance, provided it is
+            still at the given version (or whatever version it is at, if the
+            given version is None). Returns False if it is not. """
+        # Nothing keeps two version rows from being inserted for the same
+        # instance, so writers are serialized on the instance row. The
+        # version row is then read as last committed, not as of the start
+        # of the transaction.
+        db_api.model_query(context, models.Instance, session=session,
+                           read_deleted="no").\
+            filter_by(uuid=instance_uuid).\
+            with_lockmode('update').first()
+        query = db_api.model_query(context, models.InstanceMetadata,
+                                   session=session, read_deleted="no").\
+                    filter_by(instance_uuid=instance_uuid).\
+                    filter_by(key=meta.BACKUP_SCHEDULE_VERSION_KEY)
+        current = query.with_lockmode('update').first()
+        if version is None:
+            version = current and int(current['value']) or 0
+
+        if current is None:
+            # Schedules written before versioning start at version 0. A
+            # concurrent first writer holds the instance row until it has
+            # committed its version row, which then won't match.
+            if version != 0:
+                return False
+            db_api.instance_metadata_update(context, instance_uuid,
+                { meta.BACKUP_SCHEDULE_VERSION_KEY : '1' }, False,
+                session=session)
+            return True
+
+        # Compare-and-swap on the version row; a concurrent writer will
+        # simply match zero rows here.
+        updated = query.filter_by(value=str(version)).\
+                        update({ 'value' : str(version + 1) },
+                               synchronize_session=False)
+        return updated == 1
+
+    def instance_backup_schedule_update(self, context, instance_uuid,
+                                         schedule, version=None):
+        """ Updates the backup schedule for the given instance uuid. If a
+            version is given, the update only happens if the schedule is
+            still at that version. """
+        (updated, conflicts) = self.instance_backup_schedules_update(context,
+            { instance_uuid : (schedule, version) })
+        if conflicts:
+            raise driver.ScheduleVersionConflict(instance_uuid=instance_uuid)
+        return updated[instance_uuid]
+
+    def instance_backup_schedules_update(self, context, schedules):
+        """ Updates the backup schedules for several instances in a
+            single database transaction. Schedules are given with the
+            version they were read at, and conflicting ones are skipped. """
+        updated = {}
+        conflicts = []
+        session = db_api.get_session()
+        with session.begin():
+            # Instance rows are locked in order, so batches can't deadlock.
+            for (instance_uuid, (schedule, version)) in \
+                    sorted(schedules.items()):
+                if not self._backup_schedule_bump_version(context,
+                                                          instance_uuid,
+                                                          version, session):
+                    conflicts.append(instance_uuid)
+                    continue
+                (metadata, schedule) = self._backup_schedule_metadata(schedule)
+                db_api.instance_metadata_update(context, instance_uuid,
+                                                metadata, False,
+                                                session=session)
+                updated[instance_uuid] = schedule
+        return (updated, conflicts)
+
+    def instance_backup_policy_update(self, context, instance_uuid,
+                                      policy_id, schedule=None):
+        """ Sets the backup policy for the given instance uuid """
+        metadata = {}
+        if schedule is not None:
+            (metadata, schedule) = self._backup_schedule_metadata(schedule)
+        metadata[meta.BACKUP_POLICY_KEY] = policy_id or ''
+        if policy_id:
+            metadata[meta.BACKUP_ACTIVE_KEY] = True
+        session = db_api.get_session()
+        with session.begin():
+            # The effective schedule changes, so bump the version too.
+            self._backup_schedule_bump_version(context, instance_uuid,
+                                               None, session)
+            db_api.instance_metadata_update(context, instance_uuid,
+                                            metadata, False,
+                                            session=session)
+
+    def _policy_aggregate(self, context):
+        """ Returns the aggregate holding the backup policies, creating
+            it on first use """
+        for aggregate in db.aggregate_get_all(context):
+            if aggregate['name'] == meta.POLICY_AGGREGATE_NAME:
+                return aggregate
+        try:
+            return db.aggregate_create(context,
+                { 'name' : meta.POLICY_AGGREGATE_NAME })
+        except exception.AggregateNameExists:
+            # Somebody else beat us to it
+            return self._policy_aggregate(context)
+
+    def _policy_version_row(self, context, policy_id):
+        """ Returns the metadata row holding the version of the given
+            backup policy, or None """
+        return db_api.model_query(context.elevated(),
+                                  models.AggregateMetadata,
+                                  read_deleted="no").\
+                    filter_by(key=meta.POLICY_VERSION_KEY_PREFIX + policy_id).\
+                    first()
+
+    def _policy_version(self, context, policy_id):
+        """ Returns the version of the given backup policy """
+        row = self._policy_version_row(context, policy_id)
+        return row and int(row['value']) or 0
+
+    def policy_list(self, context):
+        """ Returns all backup policies, keyed by policy ID """
+        admin_context = context.elevated()
+        aggregate = self._policy_aggregate(admin_context)
+        metadata = db.aggregate_metadata_get(admin_context, aggregate['id'])
+        policies = {}
+        prefix = meta.POLICY_SCHEDULE_KEY_PREFIX
+        for (key, value) in metadata.items():
+            if not key.startswith(prefix):
+                continue
+            policy_id = key[len(prefix):]
+            name = metadata.get(meta.POLICY_NAME_KEY_PREFIX + policy_id)
+            policies[policy_id] = {
+                meta.POLICY_ID_KEY : policy_id,
+                meta.POLICY_NAME_KEY : name or policy_id,
+                meta.POLICY_SCHEDULE_KEY : jsonutils.loads(value)
+            }
+        return policies
+
+    def policy_update(self, context, policy_id, name, schedule):
+        """ Creates or updates the given backup policy """
+        admin_context = context.elevated()
+        aggregate = self._policy_aggregate(admin_context)
+        sorted_schedule = sorted(schedule,
+            key=lambda item: item[meta.SCHEDULE_FREQUENCY_KEY])
+        version = self._policy_version(context, policy_id) + 1
+        metadata = {
+            meta.POLICY_SCHEDULE_KEY_PREFIX + policy_id :
+                utils.schedule_dumps(sorted_schedule),
+            meta.POLICY_NAME_KEY_PREFIX + policy_id : name,
+            meta.POLICY_VERSION_KEY_PREFIX + policy_id : str(version)
+        }
+        db.aggregate_metadata_add(admin_context, aggregate['id'], metadata)
+        return {
+            meta.POLICY_ID_KEY : policy_id,
+            meta.POLICY_NAME_KEY : name,
+            meta.POLICY_SCHEDULE_KEY : sorted_schedule
+        }
+
+    def policy_delete(self, context, policy_id):
+        """ Deletes the given backup policy """
+        admin_context = context.elevated()
+        aggregate = self._policy_aggregate(admin_context)
+        for prefix in (meta.POLICY_SCHEDULE_KEY_PREFIX,
+                       meta.POLICY_NAME_KEY_PREFIX,
+                       meta.POLICY_VERSION_KEY_PREFIX):
+            try:
+                db.aggregate_metadata_delete(admin_context, aggregate['id'],
+                                             prefix + policy_id)
+            except exception.AggregateMetadataNotFound:
+                pass
 
     def backup_metadata_update(self, context, backup_uuid, metadata):
         image_meta = self.glance.show(context, backup_uuid)
         image_meta["properties"].update(metadata)
         self.glance.update(context, backup_uuid, image_meta, purge_props=False)
 
-    def instance_backups(self, context, instance_uuid,
-                         schedule_id=None):
-        """Get backups for the given instance."""
+    def instance_backups_iter(self, context, instance_uuid,
+                              schedule_id=None, newest_first=False):
+        """Iterate over backups for the given instance."""
         filters = { 'properties' : { meta.BACKUP_FOR_KEY : instance_uuid } }
-        backups = self.glance.detail(context,
-                                     filters=filters)
+        sort_dir = newest_first and 'desc' or 'asc'
+        page_size = CONF.veta_backup_page_size
+
+        def fetch_page(marker):
+            return self.glance.detail(context, filters=filters,
+                                      sort_key='created_at',
+                                      sort_dir=sort_dir,
+                                      limit=page_size, marker=marker)
+
+        for backup in driver.iter_pages(fetch_page, page_size, 'id'):
+            # Filter for schedule
+            if schedule_id and \
+                    schedule_id not in self._get_backup_schedules(backup):
+                continue
+            yield self._clean_backup_dict(backup)
 
-        # Filter for schedule
-        if schedule_id:
-            backups = filter(
-                lambda b: schedule_id in \
-                    self._get_backup_schedules(b), backups)
+    def all_backups_iter(self, context):
+        """Iterate over the backups of all instances."""
+        # Glance can't filter on the presence of a property, so narrow the
+        # listing down to snapshots (of any tenant) and check ourselves.
+        filters = { 'is_public' : 'none',
+                    'properties' : { 'image_type' : 'snapshot' } }
+        page_size = CONF.veta_backup_page_size
 
-        # Sort by creation time
-        backups = sorted(backups, key=lambda b: b['created_at'])
+        def fetch_page(marker):
+            return self.glance.detail(context, filters=filters,
+                                      limit=page_size, marker=marker)
 
-        # Return backups
-        return map(lambda b: self._clean_backup_dict(b), backups)
+        for image in driver.iter_pages(fetch_page, page_size, 'id'):
+            if meta.BACKUP_FOR_KEY in image['properties']:
+                yield self._clean_backup_dict(image)
+
+    def _find_backup_image(self, context, instance_uuid, key):
+        """ Returns the image of the instance's backup with the given key,
+            if any """
+        filters = { 'properties' : { meta.BACKUP_FOR_KEY : instance_uuid,
+                                     meta.BACKUP_KEY_KEY : key } }
+        for image in self.glance.detail(context, filters=filters):
+            if image['status'] not in ('killed', 'deleted'):
+                return image
+        return None
 
     def create_snapshot(self, context, instance, name, metadata=None):
+        key = (metadata or {}).get(meta.BACKUP_KEY_KEY)
+        image = key and self._find_backup_image(context, instance['uuid'],
+                                                key)
+        # The caller's record may be stale (e.g. the instance has since
+        # migrated), and the compute API needs the current one.
+        instance = db.instance_get_by_uuid(context, instance['uuid'])
+        if image:
+            if image['status'] != 'queued' or \
+                    instance['task_state'] is not None:
+                # Already (being) taken
+                return self._clean_backup_dict(image)
+            # The image was created, but the snapshot never started.
+            return self._clean_backup_dict(
+                self.nova.snapshot(context, instance, name=image['name'],
+                                   image_id=image['id']))
+
         properties = {
             'instance_uuid' : instance['uuid'],
             'image_type' : 'snapshot'
@@ -127,5 +434,20 @@ class NovaSnapshotDriver(driver.SnapshotDriver):
             self.nova.snapshot(context, instance, name=name,
                                image_id=sent_meta['id']))
 
+    def create_snapshots(self, context, snapshots):
+        """Create several snapshots in parallel."""
+        def create(snapshot):
+            (instance, name, metadata) = snapshot
+            try:
+                return self.create_snapshot(context, instance, name,
+                                            metadata)
+            except:
+                LOG.exception(_("Cannot create backup of instance %s") % \
+                              instance['uuid'])
+                return None
+
+        pool = greenpool.GreenPool(CONF.veta_snapshot_concurrency)
+        return list(pool.imap(create, snapshots))
+
     def discard_snapshot(self, context, backup_uuid):
         return self.glance.delete(context, backup_uuid)
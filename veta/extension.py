@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
 import json
 import webob
 from webob import exc
@@ -41,6 +42,19 @@ def convert_exception(action):
     fn.__name__ = action.__name__
     return fn
 
+def encode_list(items, chunk_size=100):
+    """ Encodes the items as a JSON list, a chunk of items at a time. """
+    chunk = ['[']
+    for (index, item) in enumerate(items):
+        if index > 0:
+            chunk.append(',')
+        chunk.append(json.dumps(item))
+        if len(chunk) >= 2 * chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
 def authorize(f):
     @functools.wraps(f)
     def wrapper(*args, **kwargs):
@@ -63,8 +77,11 @@ class VetaServerControllerExtension(wsgi.Controller):
     @authorize
     def _backup_schedule_list(self, req, id, body):
         context = req.environ["nova.context"]
+        etag = self.backup_api.backup_schedule_etag(context, id)
+        if etag in req.if_none_match:
+            return self._build_not_modified(req, etag)
         result = self.backup_api.backup_schedule_list(context, id)
-        return self._build_schedule(req, result)
+        return self._build_schedule(req, result, etag)
 
     @wsgi.action('backup_schedule_add')
     @convert_exception
@@ -121,21 +138,108 @@ class VetaServerControllerExtension(wsgi.Controller):
         result = self.backup_api.backup_schedule_clear(context, id)
         return self._build_schedule(req, result)
 
+    @wsgi.action('backup_schedule_set_policy')
+    @convert_exception
+    @authorize
+    def _backup_schedule_set_policy(self, req, id, body):
+        context = req.environ["nova.context"]
+        params = body.get('backup_schedule_set_policy', {})
+        result = self.backup_api.backup_schedule_set_policy(context, id,
+                                                            params)
+        return self._build_schedule(req, result)
+
     @wsgi.action('backup_schedule_list_backups')
     @convert_exception
     @authorize
     def _backup_schedule_list_backups(self, req, id, body):
         context = req.environ["nova.context"]
         params = body.get('backup_schedule_list_backups', {})
+        etag = self.backup_api.backup_list_etag(context, id, params)
+        if etag in req.if_none_match:
+            return self._build_not_modified(req, etag)
         result = self.backup_api.backup_schedule_list_backups(context, id,
                                                               params)
-        return self._build_instance_list(req, result)
+        if isinstance(result, dict):
+            # Summary of the backups
+            return self._build_schedule(req, result, etag)
+        return self._build_instance_list(req, result, etag)
+
+    def _build_schedule(self, req, schedule, etag=None):
+        return webob.Response(status_int=200, body=json.dumps(schedule),
+                              etag=etag)
+
+    def _build_instance_list(self, req, instances, etag=None):
+        # Backups are encoded as they are fetched from the driver, so that
+        # large listings are never held in memory as a whole. The first
+        # chunk is produced up front, so that errors fetching the first
+        # page of backups are still reported properly.
+        app_iter = encode_list(instances)
+        first = next(app_iter)
+        return webob.Response(status_int=200,
+                              app_iter=itertools.chain([first], app_iter),
+                              etag=etag)
+
+    def _build_not_modified(self, req, etag):
+        return webob.Response(status_int=304, etag=etag)
+
+class VetaScheduleController(wsgi.Controller):
+    """
+    Collection-level Veta actions, operating on many instances at once.
+    """
+
+    def __init__(self):
+        super(VetaScheduleController, self).__init__()
+        self.backup_api = API()
+
+    @convert_exception
+    @authorize
+    def bulk(self, req, body):
+        context = req.environ["nova.context"]
+        params = body.get('backup_schedule_bulk', {})
+        result = self.backup_api.backup_schedule_bulk(context, params)
+        return webob.Response(status_int=200, body=json.dumps(result))
+
+class VetaPolicyController(wsgi.Controller):
+    """
+    Shared backup policies, which instances may reference by ID.
+    """
 
-    def _build_schedule(self, req, schedule):
-        return webob.Response(status_int=200, body=json.dumps(schedule))
+    def __init__(self):
+        super(VetaPolicyController, self).__init__()
+        self.backup_api = API()
 
-    def _build_instance_list(self, req, instances):
-        return webob.Response(status_int=200, body=json.dumps(instances))
+    @convert_exception
+    @authorize
+    def index(self, req):
+        context = req.environ["nova.context"]
+        result = self.backup_api.backup_policy_list(context)
+        return self._build_policy(req, result)
+
+    @convert_exception
+    @authorize
+    def create(self, req, body):
+        context = req.environ["nova.context"]
+        params = body.get('backup_policy', {})
+        result = self.backup_api.backup_policy_create(context, params)
+        return self._build_policy(req, result)
+
+    @convert_exception
+    @authorize
+    def update(self, req, id, body):
+        context = req.environ["nova.context"]
+        params = body.get('backup_policy', {})
+        result = self.backup_api.backup_policy_update(context, id, params)
+        return self._build_policy(req, result)
+
+    @convert_exception
+    @authorize
+    def delete(self, req, id):
+        context = req.environ["nova.context"]
+        self.backup_api.backup_policy_delete(context, id)
+        return webob.Response(status_int=204)
+
+    def _build_policy(self, req, policy):
+        return webob.Response(status_int=200, body=json.dumps(policy))
 
 class Veta_extension(object):
     """
@@ -161,3 +265,11 @@ class Veta_extension(object):
             extension_list.append(ext)
 
         return extension_list
+
+    def get_resources(self):
+        return [extensions.ResourceExtension('gc-veta-schedules',
+                                             VetaScheduleController(),
+                                             collection_actions={
+                                                 'bulk' : 'POST' }),
+                extensions.ResourceExtension('gc-veta-policies',
+                                             VetaPolicyController())]
@@ -39,22 +39,30 @@ def novaclient(request):
     c.client.management_url = api.nova.url_for(request, 'compute')
     return c
 
+def list_backups(client, instance_id, **params):
+    # NOTE: The veta novaclient plugin does not pass through the summary
+    # and fields parameters, so we post the action directly.
+    body = { "backup_schedule_list_backups" : params }
+    resp, backups = client.client.post("/servers/%s/action" % instance_id,
+                                       body=body)
+    return backups
+
 def populate_instance(client, instance):
     class Instance(object):
-        def __init__(self, instance_id, name, schedules, backups):
+        def __init__(self, instance_id, name, schedules, backup_summary):
             self.id = instance_id
             self.name = name
             self.schedules = schedules
-            self.backups = backups
+            self.backup_summary = backup_summary
 
     # Populate schedules
     schedules = client.veta.backup_schedule_list(instance)
 
-    # Populate backups
-    backups = client.veta.backup_schedule_list_backups(instance, None)
+    # Populate backups summary (counts only, computed server-side)
+    backup_summary = list_backups(client, instance.id, summary=True)
 
     # Return populated object
-    return Instance(instance.id, instance.name, schedules, backups)
+    return Instance(instance.id, instance.name, schedules, backup_summary)
 
 def instance_list(request):
     client = novaclient(request)
@@ -147,6 +155,17 @@ def schedule_delete(request, instance_id, schedule_id):
 
     return schedules
 
+def schedule_bulk(request, action, instance_ids, params=None):
+    # NOTE: The bulk action is a collection-level resource, which the
+    # veta novaclient plugin does not wrap, so we post to it directly.
+    client = novaclient(request)
+    body = { "backup_schedule_bulk" : { "action" : action,
+                                        "instances" : instance_ids,
+                                        "params" : params or {} } }
+    resp, results = client.client.post("/gc-veta-schedules/bulk",
+                                       body=body)
+    return results
+
 def populate_backup(client, backup):
     class Backup(object):
         def __init__(self, backup_id, name, status):
@@ -164,8 +183,8 @@ def populate_backup(client, backup):
 
 def backup_list(request, instance_id, schedule_id=None):
     client = novaclient(request)
-    backups = client.veta.backup_schedule_list_backups(
-        client.servers.get(instance_id), schedule_id)
+    backups = list_backups(client, instance_id, schedule_id=schedule_id,
+                           fields=["uuid", "name", "status"])
 
     return [populate_backup(client, backup) \
             for backup in backups]
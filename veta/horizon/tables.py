@@ -15,11 +15,14 @@
 
 import json
 
+from django import shortcuts
 from django import template
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import title
 from django.utils.translation import ugettext_lazy as _
 
+from horizon import exceptions
+from horizon import messages
 from horizon import tables
 from horizon.utils.filters import replace_underscores
 
@@ -68,10 +71,11 @@ def get_schedules(instance):
         return "Every %s" % ", ".join(freqs)
 
 def get_backups(instance):
-    if len(instance.backups) == 0:
+    count = instance.backup_summary["count"]
+    if count == 0:
         return "None"
 
-    return "%d backups" % len(instance.backups)
+    return "%d backups" % count
 
 class InstancesTable(tables.DataTable):
     name = tables.Column("name",
@@ -140,6 +144,44 @@ class DeleteSchedule(tables.DeleteAction):
         schedule = self.table.get_object_by_id(schedule_id)
         api.schedule_delete(request, schedule.instance_id, schedule_id)
 
+class BulkScheduleAction(tables.BatchAction):
+    """ Applies the action to all selected schedules with a single
+        bulk request, rather than one request per schedule. """
+    bulk_action = None
+    data_type_singular = _("Schedule")
+    data_type_plural = _("Schedules")
+    classes = ("btn-camera", )
+
+    def handle(self, table, request, obj_ids):
+        instance_id = table.kwargs.get("instance_id")
+        try:
+            results = api.schedule_bulk(request, self.bulk_action,
+                                        [instance_id],
+                                        { "schedule_ids" : obj_ids })
+            error = results.get(instance_id, {}).get("error")
+            if error:
+                messages.error(request, error)
+            else:
+                messages.success(request, _("%(action)s: %(ids)s") % {
+                    "action" : self.action_past,
+                    "ids" : ", ".join(obj_ids) })
+        except:
+            exceptions.handle(request,
+                              _("Unable to %s schedules.") % self.bulk_action)
+        return shortcuts.redirect(self.get_success_url(request))
+
+class BulkEnableSchedules(BulkScheduleAction):
+    name = "bulk_enable"
+    bulk_action = "enable"
+    action_present = _("Enable")
+    action_past = _("Enabled")
+
+class BulkDisableSchedules(BulkScheduleAction):
+    name = "bulk_disable"
+    bulk_action = "disable"
+    action_present = _("Disable")
+    action_past = _("Disabled")
+
 def get_frequency(schedule):
     return "Every %s" % utils.seconds_to_epoch(schedule.frequency)
 
@@ -162,8 +204,9 @@ class BasicSchedulesTable(tables.DataTable):
 
 class SchedulesTable(BasicSchedulesTable):
     class Meta:
-        multi_select = False
-        table_actions = (CreateSchedule, )
+        multi_select = True
+        table_actions = (CreateSchedule, BulkEnableSchedules,
+                         BulkDisableSchedules)
         row_actions = (EditSchedule, EnableSchedule,
                        DisableSchedule, DeleteSchedule)
 
@@ -0,0 +1,152 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-memory index of the instances with backup schedules.
+
+The :py:class:`InstanceIndex` is rebuilt from the database by the manager
+from time to time, and kept up to date in between from Nova and Glance
+notifications (see :py:meth:`InstanceIndex.process_notification`).
+"""
+
+from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+
+from . import meta
+from . import utils
+
+LOG = logging.getLogger('nova.veta.index')
+
+class IndexEntry(object):
+    """ An instance with backup schedules. The instance record (see
+        query.InstanceRecord) is None until it has been (re)loaded from
+        the database. """
+    __slots__ = ('uuid', 'instance', 'digest', 'dirty', 'next_due',
+                 'in_progress', 'prune_at', 'prune_version', 'seen')
+
+    def __init__(self, uuid, instance=None):
+        self.uuid = uuid
+        self.instance = None
+        self.digest = None
+        # Set when something happened to the instance or its backups since
+        # the manager last looked at it.
+        self.dirty = True
+        # When the next backup of the instance is due, if known.
+        self.next_due = None
+        # How many backups of the instance were in progress.
+        self.in_progress = 0
+        # When the backups of the instance next need pruning (if known),
+        # as of the given schedule version.
+        self.prune_at = None
+        self.prune_version = None
+        # Digest of the backups the manager last looked at, see
+        # utils.backups_digest().
+        self.seen = None
+        if instance is not None:
+            self.load(instance)
+
+    def load(self, instance):
+        self.instance = instance
+        metadata = instance['metadata']
+        if not isinstance(metadata, dict):
+            metadata = dict((item['key'], item['value']) for item in metadata)
+        self.digest = metadata.get(meta.BACKUP_DIGEST_KEY)
+
+class InstanceIndex(object):
+    def __init__(self):
+        self._entries = {}
+        self.reconciled_at = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, uuid):
+        return self._entries.get(uuid)
+
+    def entries(self):
+        """ Returns a snapshot of the index entries """
+        return self._entries.values()
+
+    def needs_reconcile(self, now, frequency):
+        if self.reconciled_at is None:
+            return True
+        return timeutils.delta_seconds(self.reconciled_at, now) >= frequency
+
+    def reconcile(self, instances, now):
+        """ Rebuilds the index from a full scan of the database """
+        entries = {}
+        for instance in instances:
+            entry = IndexEntry(instance['uuid'], instance)
+            old_entry = self._entries.get(entry.uuid)
+            if old_entry is not None:
+                entry.dirty = old_entry.dirty
+                entry.next_due = old_entry.next_due
+                entry.in_progress = old_entry.in_progress
+                entry.prune_at = old_entry.prune_at
+                entry.prune_version = old_entry.prune_version
+                entry.seen = old_entry.seen
+            entries[entry.uuid] = entry
+        self._entries = entries
+        self.reconciled_at = now
+
+    def add(self, uuid):
+        """ Adds (or invalidates) the entry for the given instance, which
+            will be reloaded from the database """
+        entry = self._entries.get(uuid)
+        if entry is None:
+            self._entries[uuid] = IndexEntry(uuid)
+        else:
+            entry.instance = None
+            entry.dirty = True
+
+    def remove(self, uuid):
+        self._entries.pop(uuid, None)
+
+    def touch(self, uuid):
+        """ Marks the entry for the given instance as dirty """
+        entry = self._entries.get(uuid)
+        if entry is not None:
+            entry.dirty = True
+
+    def process_notification(self, message):
+        """ Updates the index from a Nova or Glance notification """
+        event_type = message.get('event_type', '')
+        payload = message.get('payload', {})
+
+        if event_type.startswith('compute.instance.'):
+            uuid = payload.get('instance_id')
+            metadata = payload.get('metadata')
+            if isinstance(metadata, dict) and \
+                    metadata.get(meta.BACKUP_FOR_KEY):
+                # A Cobalt backup of another instance
+                self.touch(metadata[meta.BACKUP_FOR_KEY])
+
+            if event_type.startswith('compute.instance.delete'):
+                self.remove(uuid)
+            elif event_type.startswith('compute.instance.update'):
+                if metadata is None:
+                    # We can't tell what changed, reload it if we know it
+                    if uuid in self._entries:
+                        self.add(uuid)
+                elif utils.is_true(metadata.get(meta.BACKUP_ACTIVE_KEY)):
+                    self.add(uuid)
+                else:
+                    self.remove(uuid)
+
+        elif event_type.startswith('image.'):
+            properties = payload.get('properties') or {}
+            backup_for = properties.get(meta.BACKUP_FOR_KEY)
+            if backup_for:
+                self.touch(backup_for)
@@ -0,0 +1,174 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Journal of the decisions made by the manager.
+
+When enabled, the manager writes one JSON line per backup or prune pass:
+the instances it evaluated, along with their schedules and the backups it
+looked at, the decisions it made, and how long each phase took. Prune
+passes stream through all the backups of every instance, so they are
+written one line per instance instead. Journals can be replayed offline
+with tools/veta-replay.
+"""
+
+import time
+
+from eventlet import greenthread
+
+from nova.openstack.common import jsonutils
+from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+from nova.openstack.common.gettextutils import _
+
+LOG = logging.getLogger('nova.veta.journal')
+
+# Instance fields recorded, those the manager looks at
+INSTANCE_FIELDS = ('uuid', 'display_name', 'project_id', 'user_id', 'host',
+                   'vm_state', 'power_state', 'task_state', 'created_at',
+                   'launched_at', 'updated_at')
+
+# Decisions. Evaluations record the schedules an instance needs a backup
+# for (if any), whether or not the backup is started in the same pass.
+EVALUATE = 'evaluate'
+CREATE = 'create'
+SATISFY = 'satisfy'
+UPDATE = 'update'
+DISCARD = 'discard'
+
+class Journal(object):
+    """ Records the passes of the manager to the given file, if any.
+        Everything is a no-op outside of a pass, or outside of the
+        greenthread running it. """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = bool(path)
+        self._record = None
+        self._thread = None
+        self._started = None
+        self._marked = None
+        self._per_instance = False
+
+    def _recording(self):
+        return self._record is not None and \
+            greenthread.getcurrent() is self._thread
+
+    def begin(self, kind, now, per_instance=False):
+        """ Starts recording a pass of the given kind. With per_instance,
+            each instance is written out once the next one starts, so
+            that only the backups of one instance are held at a time. """
+        if not self.enabled:
+            return
+        self._record = {
+            'pass' : kind,
+            'at' : timeutils.strtime(at=now),
+            'instances' : {},
+            'decisions' : [],
+            'timings' : {}
+        }
+        self._thread = greenthread.getcurrent()
+        self._started = self._marked = time.time()
+        self._per_instance = per_instance
+
+    def instance(self, instance, schedules, backups=(), version=None):
+        """ Records an instance evaluated, its schedules and (optionally)
+            the version of the schedules and its backups """
+        if not self._recording():
+            return
+        if self._per_instance and self._record['instances']:
+            self._flush()
+        metadata = instance['metadata']
+        if not isinstance(metadata, dict):
+            metadata = dict((item['key'], item['value']) for item in metadata)
+        record = {
+            'instance' : dict((field, instance[field]) \
+                              for field in INSTANCE_FIELDS),
+            'metadata' : metadata,
+            'schedules' : schedules,
+            'backups' : [dict(backup) for backup in backups]
+        }
+        if version is not None:
+            record['version'] = version
+        self._record['instances'][instance['uuid']] = record
+
+    def backups(self, instance_uuid, backups):
+        """ Records the backups of the instance as they are iterated """
+        record = self._recording() and \
+            self._record['instances'].get(instance_uuid) or None
+        for backup in backups:
+            if record is not None:
+                record['backups'].append(dict(backup))
+            yield backup
+
+    def changed_at(self, instance_uuid, changed_at):
+        """ Records when the schedule of the instance last changed """
+        record = self._recording() and \
+            self._record['instances'].get(instance_uuid) or None
+        if record is not None and changed_at is not None:
+            record['changed_at'] = timeutils.strtime(at=changed_at)
+
+    def acted_on(self, instance_uuid, acted_on):
+        """ Records whether the instance was acted on since its last
+            backup """
+        record = self._recording() and \
+            self._record['instances'].get(instance_uuid) or None
+        if record is not None:
+            record['acted_on'] = acted_on
+
+    def decision(self, action, instance_uuid, backup_uuid=None, **details):
+        if not self._recording():
+            return
+        self._record['decisions'].append([action, instance_uuid,
+                                          backup_uuid, details])
+
+    def mark(self, phase):
+        """ Records the time spent since the previous phase """
+        if not self._recording():
+            return
+        now = time.time()
+        self._record['timings'][phase] = round(now - self._marked, 6)
+        self._marked = now
+
+    def _flush(self):
+        """ Writes out the instances recorded so far in the pass """
+        record = self._record
+        self._record = dict(record, instances={}, decisions=[], timings={})
+        now = time.time()
+        record['elapsed'] = round(now - self._started, 6)
+        self._started = now
+        self._write(record)
+
+    def end(self, failed=False):
+        """ Finishes recording the pass, and writes it out """
+        if not self._recording():
+            return
+        record = self._record
+        self._record = None
+        self._thread = None
+        if failed:
+            record['failed'] = True
+        record['elapsed'] = round(time.time() - self._started, 6)
+        self._write(record)
+
+    def _write(self, record):
+        try:
+            self.write(record)
+        except:
+            LOG.exception(_("Unable to write to the journal %s" % self.path))
+
+    def write(self, record):
+        with open(self.path, 'a') as journal:
+            journal.write(jsonutils.dumps(record) + '\n')
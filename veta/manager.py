@@ -21,11 +21,17 @@ does periodic processing of backup tasks.
 """
 
 import datetime
+import time
 from copy import copy
 
+from eventlet import greenthread
+
 from nova import context as novacontext
 from nova import exception
 from nova import manager
+from nova import utils as novautils
+from nova.compute import power_state
+from nova.compute import vm_states
 from nova.openstack.common import jsonutils
 from nova.openstack.common import log as logging
 from nova.openstack.common import timeutils
@@ -36,11 +42,35 @@ from keystoneclient.v2_0 import client as keystone
 from oslo.config import cfg
 
 from . import driver
+from . import index
+from . import journal
 from . import meta
+from . import profiler
+from . import query
+from . import scheduler
+from . import utils
 
 LOG = logging.getLogger('nova.veta.manager')
 CONF = cfg.CONF
 
+# Instances in these states aren't running, so they can't change without
+# first being started (or rebuilt) again. Older versions of Nova don't
+# know about shelving.
+QUIESCENT_VM_STATES = tuple(state for state in \
+    (vm_states.STOPPED, vm_states.SUSPENDED,
+     getattr(vm_states, 'SHELVED', None),
+     getattr(vm_states, 'SHELVED_OFFLOADED', None)) if state is not None)
+
+# Share of the backup pass's time budget kept for starting backups
+START_BUDGET_SHARE = 0.25
+
+# Topics notifications are sent to
+NOTIFICATION_TOPIC_PREFIX = 'notifications.'
+
+# The lock held while evaluating, pruning or snapshotting instances. Waiting
+# for it doesn't count toward the time of profiled cycles.
+_backups_locked = profiler.synchronized(novautils.synchronized('veta-backups'))
+
 veta_opts = [
                 cfg.IntOpt('veta_poll_frequency',
                 default=60,
@@ -48,6 +78,12 @@ veta_opts = [
                      ' service should wake up and perform peroidic tasks'
                      ' (such as triggering new backups or cleaning up'
                      ' old backups.'),
+                cfg.IntOpt('veta_prune_frequency',
+                default=600,
+                help='The frequency with which the veta service should'
+                     ' discard backups that are no longer needed. This'
+                     ' lists all backups, so is more expensive than'
+                     ' triggering new backups.'),
                 cfg.StrOpt('veta_auth_strategy',
                 default='none',
                 help='The authorization strategy that the veta'
@@ -68,18 +104,204 @@ veta_opts = [
                 cfg.StrOpt('veta_auth_url',
                 default='http://127.0.0.1:5000/v2.0',
                 help='The Keystone auth URL, if the Veta'
-                     ' authorization strategy is "keystone".')]
+                     ' authorization strategy is "keystone".'),
+                cfg.BoolOpt('veta_notifications',
+                default=False,
+                help='Whether the veta manager should keep track of'
+                     ' instances from Nova and Glance notifications,'
+                     ' rather than scanning the database every period.'),
+                cfg.ListOpt('veta_notification_topics',
+                default=['notifications.info'],
+                help='The notification topics to consume, if'
+                     ' veta_notifications is enabled. Only'
+                     ' notifications.* topics are consumed.'),
+                cfg.ListOpt('veta_notification_exchanges',
+                default=['nova', 'glance'],
+                help='The exchanges to consume notifications from, if'
+                     ' veta_notifications is enabled.'),
+                cfg.StrOpt('veta_notification_pool',
+                default='veta.notifications',
+                help='The name of the queue notifications are consumed'
+                     ' from, which must differ from the Veta topic.'),
+                cfg.IntOpt('veta_reconcile_frequency',
+                default=3600,
+                help='The frequency with which the veta manager rescans'
+                     ' the database for instances with backup schedules,'
+                     ' if veta_notifications is enabled.'),
+                cfg.IntOpt('veta_orphan_sweep_frequency',
+                default=3600,
+                help='The frequency with which the veta manager looks'
+                     ' for backups of deleted instances.'),
+                cfg.IntOpt('veta_orphan_grace_period',
+                default=7 * 24 * 60 * 60,
+                help='How long (in seconds) the backups of a deleted'
+                     ' instance are kept after it was deleted.'),
+                cfg.IntOpt('veta_orphan_batch_size',
+                default=50,
+                help='The maximum number of orphaned backups deleted'
+                     ' per sweep.'),
+                cfg.FloatOpt('veta_orphan_delete_interval',
+                default=1.0,
+                help='The time (in seconds) to wait between deleting'
+                     ' orphaned backups.'),
+                cfg.IntOpt('veta_snapshot_timeout',
+                default=6 * 60 * 60,
+                help='How long (in seconds) a snapshot may take before'
+                     ' it is considered stuck and deleted.'),
+                cfg.FloatOpt('veta_catchup_threshold',
+                default=2.0,
+                help='How overdue (as a multiple of its frequency) a'
+                     ' schedule must be for its backup to be caught up'
+                     ' gradually, such as after an outage of the manager.'),
+                cfg.IntOpt('veta_catchup_rate',
+                default=10,
+                help='The maximum number of overdue backups started per'
+                     ' period while catching up.'),
+                cfg.FloatOpt('veta_defer_slack',
+                default=0.25,
+                help='How long (as a fraction of the schedule frequency)'
+                     ' a backup may be deferred past its due time while'
+                     ' its compute host is busy. 0 disables deferral.'),
+                cfg.IntOpt('veta_defer_max_workload',
+                default=4,
+                help='The workload (number of tasks in progress) at'
+                     ' which a compute host is considered busy.'),
+                cfg.IntOpt('veta_defer_max_running_vms',
+                default=0,
+                help='The number of running instances at which a compute'
+                     ' host is considered busy. 0 means no limit.'),
+                cfg.FloatOpt('veta_defer_min_free_disk',
+                default=0.1,
+                help='The fraction of free local disk below which a'
+                     ' compute host is considered busy.'),
+                cfg.IntOpt('veta_max_snapshots',
+                default=0,
+                help='The maximum number of snapshots in progress at'
+                     ' any time, over all tenants. 0 means no limit.'),
+                cfg.IntOpt('veta_tenant_max_snapshots',
+                default=0,
+                help='The maximum number of snapshots in progress at'
+                     ' any time for each tenant, unless set in'
+                     ' veta_tenant_snapshot_quotas. 0 means no limit.'),
+                cfg.ListOpt('veta_tenant_snapshot_quotas',
+                default=[],
+                help='The maximum number of snapshots in progress at'
+                     ' any time for specific tenants, as a list of'
+                     ' <project id>:<count>.'),
+                cfg.ListOpt('veta_tenant_weights',
+                default=[],
+                help='The share of snapshots of specific tenants'
+                     ' relative to the others (whose weight is 1.0) when'
+                     ' snapshots are limited, as a list of'
+                     ' <project id>:<weight>.'),
+                cfg.BoolOpt('veta_align_schedules',
+                default=False,
+                help='Align the backups of all the schedules of an'
+                     ' instance on a common (per-instance) anchor, so'
+                     ' that the backups of longer schedules coincide'
+                     ' with backups of shorter ones.'),
+                cfg.IntOpt('veta_coalesce_window',
+                default=300,
+                help='How long (in seconds) ahead of their due time the'
+                     ' backups of other schedules of an instance may be'
+                     ' taken along with a backup that is due. 0 disables'
+                     ' coalescing.'),
+                cfg.FloatOpt('veta_coalesce_tolerance',
+                default=0.05,
+                help='How early (as a fraction of its frequency) the'
+                     ' backup of a schedule may be taken along with'
+                     ' another one, for schedules that don\'t set their'
+                     ' own tolerance.'),
+                cfg.IntOpt('veta_cycle_budget',
+                default=45,
+                help='How long (in seconds) each backup or prune pass'
+                     ' may run. Instances not processed in time are'
+                     ' processed first in the next pass. 0 means no'
+                     ' limit.'),
+                cfg.IntOpt('veta_prune_max_deferrals',
+                default=3,
+                help='How many prune passes in a row may be skipped in'
+                     ' favour of backups carried over by the backup'
+                     ' pass.'),
+                cfg.StrOpt('veta_journal_path',
+                default=None,
+                help='File to record the decisions of each backup and'
+                     ' prune pass to, as JSON lines, for replaying them'
+                     ' with tools/veta-replay.'),
+                cfg.BoolOpt('veta_orphan_dry_run',
+                default=False,
+                help='Only report orphaned backups, do not delete'
+                     ' them.')]
 CONF.register_opts(veta_opts)
+CONF.import_opt('veta_topic', 'veta.rpcapi')
+
+def _tenant_settings(items, convert):
+    """ Parses a list of <project id>:<value> into a dictionary """
+    settings = {}
+    for item in items:
+        try:
+            (project, value) = item.rsplit(':', 1)
+            value = convert(value)
+            if value <= 0:
+                raise ValueError()
+            settings[project.strip()] = value
+        except ValueError:
+            LOG.warn(_("Ignoring invalid tenant setting '%s'" % item))
+    return settings
 
 # Round (down) to nearest minute
 def _nearest_minute(dt):
     return datetime.datetime(dt.year, dt.month, dt.day, dt.hour, dt.minute)
 
 class VetaManager(manager.SchedulerDependentManager):
+    RPC_API_VERSION = '1.0'
+
     def __init__(self, *args, **kwargs):
         super(VetaManager, self).__init__(service_name="veta", *args, **kwargs)
         self._setup_auth()
         self.driver = driver.load_snapshot_driver()
+        # Count of changes made to backups, see _update_backups_digest
+        self._backup_changes = 0
+        # Count of backups that couldn't be discarded
+        self._discard_failures = 0
+        # Instances left over by passes that ran out of time, and the
+        # number of times each kind of pass did
+        self._trigger_carry_over = []
+        self._prune_carry_over = []
+        self._overruns = { 'backup' : 0, 'prune' : 0 }
+        self._prunes_deferred = 0
+        # Greenthread discarding orphaned backups, if any
+        self._orphan_reaper = None
+        self._journal = journal.Journal(CONF.veta_journal_path)
+        # Instances with backup schedules
+        self._index = index.InstanceIndex()
+
+    def pre_start_hook(self, rpc_connection=None, **kwargs):
+        super(VetaManager, self).pre_start_hook(
+            rpc_connection=rpc_connection, **kwargs)
+        if not CONF.veta_notifications or rpc_connection is None:
+            return
+        # Notifications get a queue of their own, as the one named after
+        # the Veta topic is the RPC dispatcher's.
+        pool = CONF.veta_notification_pool
+        if pool == CONF.veta_topic:
+            raise exception.NovaException(
+                _("veta_notification_pool must differ from veta_topic"))
+        for topic in CONF.veta_notification_topics:
+            if not topic.startswith(NOTIFICATION_TOPIC_PREFIX):
+                LOG.warn(_("Not consuming notifications from topic %s" % \
+                           topic))
+                continue
+            for exchange in CONF.veta_notification_exchanges:
+                rpc_connection.join_consumer_pool(
+                    self._process_notification, pool, topic, exchange)
+
+    def _process_notification(self, message):
+        try:
+            self._index.process_notification(message)
+        except:
+            LOG.exception(_("Unable to process notification %s" % \
+                            message.get('event_type')))
 
     def _setup_auth(self):
         # If we are using Keystone,
@@ -108,48 +330,587 @@ class VetaManager(manager.SchedulerDependentManager):
     def _run_periodic_tasks(self, context):
         context = self._generate_context(context)
         LOG.debug("Periodic tasks running with context %s" % context.to_dict())
-        self._run_backups(context)
+        profiler.profiled('backup', self._run_backups, context)
+
+    @manager.periodic_task(spacing=CONF.veta_prune_frequency)
+    def _run_prune_tasks(self, context):
+        context = self._generate_context(context)
+        profiler.profiled('prune', self._run_prunes, context)
 
+    @manager.periodic_task(spacing=CONF.veta_orphan_sweep_frequency)
+    def _run_orphan_sweep(self, context):
+        context = self._generate_context(context)
+        if self._orphan_reaper is not None and not self._orphan_reaper.dead:
+            LOG.info(_("Still discarding the last batch of orphaned "
+                       "backups, skipping this sweep"))
+            return
+
+        now = timeutils.utcnow()
+        orphans = self._orphaned_backups(context, now,
+                                         CONF.veta_orphan_batch_size)
+
+        # Report what we found
+        for (backup, reason) in orphans:
+            LOG.info(_("Orphaned backup %s of instance %s (%s)%s" % \
+                       (backup['uuid'], backup[meta.BACKUP_FOR_KEY], reason,
+                        CONF.veta_orphan_dry_run and ", dry run" or "")))
+        if len(orphans) >= CONF.veta_orphan_batch_size:
+            LOG.info(_("More orphaned backups may be left for the next "
+                       "sweep"))
+        if CONF.veta_orphan_dry_run or not orphans:
+            return
+
+        # Delete them at a limited rate, in the background, so as not to
+        # get in the way of everything else.
+        self._orphan_reaper = greenthread.spawn(self._discard_orphans,
+            context, [backup for (backup, __) in orphans])
+
+    def _discard_orphans(self, context, backups):
+        for backup in backups:
+            try:
+                self.driver.discard_snapshot(context, backup['uuid'])
+                LOG.info(_("Discarded orphaned backup with uuid %s" % \
+                           backup['uuid']))
+            except:
+                LOG.exception(_("Cannot discard orphaned backup with uuid "
+                                "%s, will retry" % backup['uuid']))
+            greenthread.sleep(CONF.veta_orphan_delete_interval)
+
+    def _orphaned_backups(self, context, now, limit=None):
+        """ Returns the backups whose instance was deleted more than the
+            grace period ago, along with a description of why, stopping
+            once the limit (if any) is reached """
+        deleted_context = context.elevated(read_deleted='yes')
+        owners = {}
+        orphans = []
+        for backup in self.driver.all_backups_iter(context):
+            if limit is not None and len(orphans) >= limit:
+                break
+            owner_uuid = backup[meta.BACKUP_FOR_KEY]
+            if owner_uuid not in owners:
+                try:
+                    owner = self.db.instance_get_by_uuid(deleted_context,
+                                                         owner_uuid)
+                    owners[owner_uuid] = owner['deleted'] and \
+                        (owner['deleted_at'], "instance deleted") or None
+                except exception.InstanceNotFound:
+                    # No trace of the instance left, use the backup time.
+                    owners[owner_uuid] = (None, "instance not found")
+
+            if owners[owner_uuid] is None:
+                # Still alive
+                continue
+            (deleted_at, reason) = owners[owner_uuid]
+            if deleted_at is None:
+                (deleted_at, __, __) = self._backup_metadata_get(backup)
+            if timeutils.delta_seconds(deleted_at, now) >= \
+                    CONF.veta_orphan_grace_period:
+                orphans.append((backup, reason))
+        return orphans
+
+    # Passes only hold the 'veta-backups' lock while evaluating or pruning
+    # an instance, or starting a batch of backups, and yield in between,
+    # so that schedule changes are evaluated without waiting for a pass.
     def _run_backups(self, context):
         # The current time
         now = _nearest_minute(timeutils.utcnow())
+        self._journal.begin('backup', now)
+        try:
+            self._backup_pass(context, now)
+        except:
+            self._journal.end(failed=True)
+            raise
+        self._journal.end()
+
+    def _backup_pass(self, context, now):
+        deadline = self._cycle_deadline()
 
         # Find instances with backup schedules
-        filters = { 'metadata' : { meta.BACKUP_ACTIVE_KEY : True } }
-        instances = self.db.instance_get_all_by_filters(context,
-                                                        filters)
+        entries = self._scheduled_instances(context, now)
         LOG.info(_("Instances with backup schedules: %s" % \
-                    [instance['uuid'] for instance in instances]))
-        for instance in instances:
-            # Get instance UUID
-            uuid = instance['uuid']
+                    [entry.uuid for entry in entries]))
+
+        # Resolve shared backup policies once for all instances. The
+        # parsed schedules are shared, and must not be modified.
+        policies = self.driver.policy_list(context)
+
+        # Pick up where the last pass left off. Part of the budget is kept
+        # for starting the backups.
+        entries = self._carried_over_first(entries, self._trigger_carry_over)
+        self._trigger_carry_over = []
+        evaluate_deadline = deadline and \
+            deadline - CONF.veta_cycle_budget * START_BUDGET_SHARE
+
+        pending = []
+        for (i, entry) in enumerate(entries):
+            if deadline is not None and time.time() >= evaluate_deadline:
+                self._trigger_carry_over = [left.uuid for left in \
+                    entries[i:] if self._needs_trigger(left, now)]
+                self._report_overrun('backup', i,
+                                     len(self._trigger_carry_over))
+                break
+            if not self._needs_trigger(entry, now):
+                continue
+            backup = self._trigger_instance(context, entry, policies, now)
+            if backup:
+                pending.append(backup)
+            greenthread.sleep(0)
+        self._journal.mark('evaluate')
 
-            # Get backup schedules
-            schedules = self.driver.instance_backup_schedule(context, uuid)
+        # Start backups, catching up gradually on overdue ones
+        (released, deferred) = scheduler.release_catchup(pending,
+            CONF.veta_catchup_threshold, CONF.veta_catchup_rate)
+        if deferred:
+            LOG.info(_("Catching up on backups, %d overdue backups "
+                       "deferred" % len(deferred)))
 
-            # Get backups
-            backups = self.driver.instance_backups(context, uuid)
+        # Hold off on backups of instances on busy hosts for a while
+        if released and CONF.veta_defer_slack > 0:
+            (released, deferred) = scheduler.defer_busy(released,
+                self._host_loads(context), CONF.veta_defer_max_workload,
+                CONF.veta_defer_slack)
+            if deferred:
+                LOG.info(_("Deferred backups of %s, their hosts are busy" % \
+                           [backup.instance['uuid'] for backup in deferred]))
 
-            # Sort backups by creation time, descending
-            backups = sorted(backups, key=lambda b: b[meta.BACKUP_AT_KEY],
-                             reverse=True)
+        # Share what capacity there is fairly among tenants
+        released = self._fair_share(released)
+        self._journal.mark('schedule')
 
-            # Trigger new backups for instance
-            self._trigger_instance_backups(context, instance, schedules,
-                                           backups, now)
+        unstarted = self._start_backups(context, released, now, deadline)
+        if unstarted:
+            # Evaluate those first next time
+            self._trigger_carry_over[:0] = [backup.instance['uuid'] \
+                                            for backup in unstarted]
+            self._report_overrun('backup', len(released) - len(unstarted),
+                                 len(unstarted))
+        self._journal.mark('start')
 
-            # Cull old instance backups
-            self._prune_instance_backups(context, instance, schedules,
-                                         backups, now)
+    def _cycle_deadline(self):
+        if not CONF.veta_cycle_budget:
+            return None
+        return time.time() + CONF.veta_cycle_budget
+
+    def _carried_over_first(self, entries, carry_over):
+        """ Returns the entries, those carried over first """
+        if not carry_over:
+            return entries
+        carry_over = set(carry_over)
+        return [entry for entry in entries if entry.uuid in carry_over] + \
+               [entry for entry in entries if entry.uuid not in carry_over]
+
+    def _report_overrun(self, kind, processed, carried_over):
+        self._overruns[kind] += 1
+        LOG.warn(_("The %s pass ran out of time after %d instances, "
+                   "%d instances carried over (%d %s overruns so far)" % \
+                   (kind, processed, carried_over, self._overruns[kind],
+                    kind)))
+
+    def _fair_share(self, backups):
+        """ Returns the given backups that can be started within the
+            snapshot quotas, in the order to start them. """
+        in_progress = {}
+        for entry in self._index.entries():
+            if entry.in_progress and entry.instance is not None:
+                project = entry.instance['project_id']
+                in_progress[project] = in_progress.get(project, 0) + \
+                                           entry.in_progress
+        (released, deferred) = scheduler.fair_share(backups, in_progress,
+            CONF.veta_max_snapshots or None,
+            _tenant_settings(CONF.veta_tenant_weights, float),
+            _tenant_settings(CONF.veta_tenant_snapshot_quotas, int),
+            CONF.veta_tenant_max_snapshots or None)
+        if deferred:
+            LOG.info(_("Deferred backups of %s, their tenants are at their "
+                       "snapshot quota" % \
+                       [backup.instance['uuid'] for backup in deferred]))
+        return released
+
+    def _host_loads(self, context):
+        """ Returns the load of each compute host, based on the compute
+            node statistics. Hosts that are low on disk or running too many
+            instances are considered fully loaded. """
+        loads = {}
+        for node in self.db.compute_node_get_all(context):
+            load = node['current_workload'] or 0
+            if node['local_gb'] and node['free_disk_gb'] is not None and \
+                    float(node['free_disk_gb']) / node['local_gb'] < \
+                        CONF.veta_defer_min_free_disk:
+                load = float('inf')
+            if CONF.veta_defer_max_running_vms and \
+                    (node['running_vms'] or 0) >= \
+                        CONF.veta_defer_max_running_vms:
+                load = float('inf')
+            host = node['service']['host']
+            loads[host] = max(loads.get(host, 0), load)
+        return loads
+
+    def _needs_trigger(self, entry, now):
+        # When notifications keep the index up to date, instances whose
+        # backups and schedules haven't changed needn't be looked at
+        # before their next backup is due.
+        # Instances with backups in progress are looked at until those
+        # complete or fail.
+        if not CONF.veta_notifications or entry.dirty or entry.in_progress:
+            return True
+        return entry.next_due is None or entry.next_due <= now
+
+    @_backups_locked
+    def _trigger_instance(self, context, entry, policies, now):
+        """ Evaluates the schedules of the instance. Returns the backup to
+            take, if any. """
+        # Get instance UUID
+        uuid = entry.uuid
+        instance = entry.instance
+
+        # Get backup schedules
+        schedules = self.driver.instance_backup_schedule(context, uuid,
+                                                         policies)
+
+        # Get the most recent backups, going back only as far as the last
+        # backup of each active schedule.
+        failed = []
+        backups = self._recent_backups(context, uuid, schedules, now, failed)
+        self._journal.instance(instance, schedules, backups + failed)
+        changes = self._backup_changes
+
+        # Find out whether the instance needs a new backup
+        pending = self._trigger_instance_backups(context, instance,
+                                                 schedules, backups, now)
+        self._journal.decision(journal.EVALUATE, uuid,
+                               schedules=pending and pending.schedules or [],
+                               key=pending and pending.key or None)
+
+        # Backups also change outside of Veta, as snapshots complete or
+        # fail, or images are deleted.
+        seen = utils.backups_digest(backups + failed)
+        if self._backup_changes != changes or entry.seen != seen:
+            self._invalidate_backups_digest(context, entry, now)
+
+        # Make sure the next prune gets to failed and new backups, and to
+        # any other change.
+        if failed or entry.seen != seen:
+            entry.prune_at = None
+        elif pending is not None and entry.prune_at is not None:
+            entry.prune_at = min(entry.prune_at,
+                                 self._new_backup_expires_at(schedules,
+                                                             pending, now))
+        entry.seen = seen
+        entry.in_progress = len([backup for backup in backups if \
+            utils.backup_state(backup, now, CONF.veta_snapshot_timeout) == \
+                utils.BACKUP_PENDING])
+        entry.next_due = pending is None and \
+            self._next_due(schedules, backups,
+                           self._schedule_anchor(instance)) or None
+        entry.dirty = False
+        return pending
+
+    def _recent_backups(self, context, uuid, schedules, now, failed=None):
+        """ Returns the backups of the instance, most recent first, down
+            to the last backup of each active schedule. Failed backups
+            are left out, and added to the given list if any. """
+        wanted = set(schedule[meta.SCHEDULE_ID_KEY] for schedule in \
+                     schedules if schedule[meta.SCHEDULE_ACTIVE_KEY] == True)
+        backups = []
+        for backup in self.driver.instance_backups_iter(context, uuid,
+                                                        newest_first=True):
+            if utils.backup_state(backup, now, CONF.veta_snapshot_timeout) \
+                    == utils.BACKUP_FAILED:
+                if failed is not None:
+                    failed.append(backup)
+                continue
+            backups.append(backup)
+            (__, __, satisfies) = self._backup_metadata_get(backup)
+            wanted.difference_update(satisfies)
+            if not wanted:
+                break
+        return backups
+
+    def _next_due(self, schedules, backups, anchor=None):
+        """ Returns the time at which the next backup of the instance is
+            due, or None if that depends on more than the passage of
+            time """
+        next_due = None
+        for schedule in schedules:
+            (schedule_uuid, frequency, __, active) = \
+                self._schedule_metadata_get(schedule)
+            if active != True:
+                continue
+            last_backup = self._last_backup(backups, schedule_uuid)
+            if not last_backup:
+                return None
+            due = self._backup_due_at(last_backup, frequency, anchor,
+                                      self._schedule_tolerance(schedule))
+            if next_due is None or due < next_due:
+                next_due = due
+        return next_due
+
+    def _backup_due_at(self, last_backup, frequency, anchor=None,
+                       tolerance=0):
+        """ Returns the time at which the backup following the given one
+            is due, for a schedule of the given frequency """
+        (ts, __, __) = self._backup_metadata_get(last_backup)
+        if anchor is None:
+            return ts + datetime.timedelta(seconds=frequency)
+        # See _backup_is_current
+        ts_slot = ts + datetime.timedelta(seconds=tolerance)
+        return max(utils.slot_start(ts_slot, frequency, anchor) + \
+                       datetime.timedelta(seconds=frequency),
+                   ts + datetime.timedelta(seconds=frequency / 2))
+
+    def _run_prunes(self, context):
+        # The current time
+        now = _nearest_minute(timeutils.utcnow())
+
+        # Backups that are due come first, for a while.
+        if self._trigger_carry_over and \
+                self._prunes_deferred < CONF.veta_prune_max_deferrals:
+            self._prunes_deferred += 1
+            LOG.info(_("Deferring pruning, %d instances are due for "
+                       "backups" % len(self._trigger_carry_over)))
+            return
+        self._prunes_deferred = 0
+
+        self._journal.begin('prune', now, per_instance=True)
+        try:
+            self._prune_pass(context, now)
+        except:
+            self._journal.end(failed=True)
+            raise
+        self._journal.end()
+
+    def _prune_pass(self, context, now):
+        deadline = self._cycle_deadline()
+
+        # Resolve shared backup policies once for all instances.
+        policies = self.driver.policy_list(context)
+
+        # Pick up where the last pass left off
+        entries = self._carried_over_first(
+            self._scheduled_instances(context, now), self._prune_carry_over)
+        self._prune_carry_over = []
+
+        for (i, entry) in enumerate(entries):
+            if deadline is not None and time.time() >= deadline:
+                self._prune_carry_over = [left.uuid for left in entries[i:]]
+                self._report_overrun('prune', i,
+                                     len(self._prune_carry_over))
+                break
+
+            # Skip instances whose backups don't expire yet, unless their
+            # schedules changed.
+            (version, __) = self.driver.instance_backup_versions(context,
+                                                                 entry.uuid)
+            if entry.prune_version == version and \
+                    entry.prune_at is not None and entry.prune_at > now:
+                continue
+            self._prune_instance(context, entry, policies, now, version)
+            greenthread.sleep(0)
+        self._journal.mark('prune')
+
+    @_backups_locked
+    def _prune_instance(self, context, entry, policies, now, version):
+        """ Discards the backups of the instance that are no longer needed
+            by any of its schedules, as well as failed backups. The
+            version is that of the instance's schedules. """
+        # Get instance UUID
+        uuid = entry.uuid
+        instance = entry.instance
+
+        # Get backup schedules
+        schedules = self.driver.instance_backup_schedule(context, uuid,
+                                                         policies)
+
+        # Schedules only backing up changed instances keep their newest
+        # backup regardless of retention, as it may be the only one.
+        only_changed = [schedule for schedule in schedules \
+                        if self._schedule_only_changed(schedule)]
+        if only_changed:
+            recent = self._recent_backups(context, uuid, only_changed, now)
+            keep = {}
+            for schedule in only_changed:
+                last_backup = self._last_backup(recent,
+                                                schedule[meta.SCHEDULE_ID_KEY])
+                if last_backup:
+                    keep[schedule[meta.SCHEDULE_ID_KEY]] = last_backup['uuid']
+        else:
+            keep = {}
+
+        # Stream the backups, oldest first, through the pipeline below so
+        # that only a page or so of them is held at any time.
+        self._journal.instance(instance, schedules, version=version)
+        backups = self._journal.backups(uuid,
+            self.driver.instance_backups_iter(context, uuid))
+        changes = self._backup_changes
+        discard_failures = self._discard_failures
+
+        # Snapshots that failed or got stuck don't count as backups,
+        # get rid of them.
+        backups = self._reap_failed_backups(context, backups, now)
+
+        # Cull old instance backups
+        backups = self._prune_instance_backups(context, instance, schedules,
+                                               backups, now, keep, version)
+
+        # Publish the state of the remaining backups for conditional
+        # requests, and find out when the next of them expires.
+        digest = utils.BackupsDigest()
+        prune_at = datetime.datetime.max
+        for backup in backups:
+            digest.update(backup)
+            expires_at = self._backup_expires_at_get(backup)
+            if expires_at is not None and now < expires_at < prune_at:
+                prune_at = expires_at
+        self._update_backups_digest(context, entry, digest.hexdigest(), now,
+                                    self._backup_changes != changes)
+
+        # Don't wait longer than a backup period either, so that changes
+        # made outside of Veta don't go unnoticed until then.
+        frequencies = [schedule[meta.SCHEDULE_FREQUENCY_KEY] \
+                       for schedule in schedules]
+        if frequencies:
+            prune_at = min(prune_at, now + datetime.timedelta(
+                seconds=min(frequencies)))
+
+        # Try again next time if backups couldn't be discarded.
+        if self._discard_failures != discard_failures:
+            prune_at = None
+        entry.prune_at = prune_at
+        entry.prune_version = version
+
+    def _reap_failed_backups(self, context, backups, now):
+        """ Discards the given backups that failed, a batch at a time, and
+            yields the others. """
+        failed = []
+        for backup in backups:
+            if utils.backup_state(backup, now, CONF.veta_snapshot_timeout) \
+                    != utils.BACKUP_FAILED:
+                yield backup
+                continue
+            failed.append(backup)
+            if len(failed) >= CONF.veta_backup_page_size:
+                self._discard_backups(context, failed)
+                failed = []
+        if failed:
+            self._discard_backups(context, failed)
+
+    def _start_backups(self, context, backups, now, deadline=None):
+        """ Starts the given backups, until the deadline (if any) passes.
+            Returns those that weren't started. """
+        create_snapshots = getattr(self.driver, 'create_snapshots', None)
+        if create_snapshots is not None:
+            # Let the driver create several at once
+            batch_size = max(CONF.veta_snapshot_concurrency, 1)
+        else:
+            batch_size = 1
+        for i in range(0, len(backups), batch_size):
+            if deadline is not None and time.time() >= deadline:
+                return backups[i:]
+            self._start_backup_batch(context, backups[i:i + batch_size], now)
+            greenthread.sleep(0)
+        return []
+
+    @_backups_locked
+    def _start_backup_batch(self, context, batch, now):
+        if len(batch) > 1:
+            created = self._create_backups(context, batch, now)
+        else:
+            created = [self._create_backup(context, backup.instance,
+                                           backup.schedules, now, backup.key)
+                       for backup in batch]
+        for (backup, created_backup) in zip(batch, created):
+            entry = self._index.get(backup.instance['uuid'])
+            if entry is not None:
+                # Even failed attempts may have left something behind
+                self._invalidate_backups_digest(context, entry, now)
+            if created_backup is None:
+                continue
+            self._journal.decision(journal.CREATE, backup.instance['uuid'],
+                                   created_backup['uuid'],
+                                   schedules=backup.schedules, key=backup.key)
+            if entry is not None:
+                entry.in_progress += 1
+
+    def schedules_changed(self, context, instance_uuids):
+        """ Called by the API when the schedules of the given instances
+            change, so they are evaluated by the next backup pass rather
+            than when their next backup was due. Backups are left to the
+            pass, which starts them gradually like any other. """
+        now = _nearest_minute(timeutils.utcnow())
+        for uuid in instance_uuids:
+            self._index.add(uuid)
+            entry = self._index.get(uuid)
+            entry.next_due = now
+            # Retention may have changed too
+            entry.prune_at = None
+
+    def _scheduled_instances(self, context, now):
+        # Without notifications, the database is the only way to find out
+        # about instances, so scan it every time.
+        frequency = CONF.veta_notifications and \
+                        CONF.veta_reconcile_frequency or 0
+        if self._index.needs_reconcile(now, frequency):
+            instances = query.scheduled_instances(context)
+            self._index.reconcile(instances, now)
+
+        return self._load_entries(context)
+
+    def _load_entries(self, context):
+        """ Returns the index entries, loading their instance records
+            where needed """
+        loaded = []
+        for entry in self._index.entries():
+            if entry.instance is None:
+                # New or changed since we last loaded it
+                try:
+                    entry.load(query.instance_get(context, entry.uuid))
+                except exception.InstanceNotFound:
+                    self._index.remove(entry.uuid)
+                    continue
+            loaded.append(entry)
+        return loaded
+
+    def _update_backups_digest(self, context, entry, digest, now, changed):
+        # If we changed the backups ourselves, the listing is already out
+        # of date, so make sure the digest differs from any previous one.
+        # The next prune will then pick up the new listing.
+        if changed:
+            salt = "%s%s" % (digest, timeutils.strtime(at=now))
+            digest = utils.backups_digest([], salt)
+        self._set_backups_digest(context, entry, digest)
+
+    def _invalidate_backups_digest(self, context, entry, now):
+        # We changed the backups without listing them all, so just make
+        # sure the digest changes.
+        salt = "%s%s" % (entry.digest, timeutils.strtime(at=now))
+        self._set_backups_digest(context, entry,
+                                 utils.backups_digest([], salt))
+
+    def _set_backups_digest(self, context, entry, digest):
+        if entry.digest != digest:
+            self.driver.instance_backups_digest_update(context, entry.uuid,
+                                                       digest)
+            entry.digest = digest
 
     def _trigger_instance_backups(self, context, instance, schedules,
                                   backups, now):
         # List of needed backups
         backups_needed = []
+        staleness = 0.0
+        min_frequency = None
+        due_at = None
+        changed_at = None
 
         # Most recent backup for all schedules
         most_recent = self._last_backup(backups)
 
+        # Anchor of the schedules, if aligned
+        anchor = self._schedule_anchor(instance)
+
+        # Schedules whose last backup is current, and when their next
+        # backup is due
+        upcoming = []
+
         # For each schedule,
         for schedule in schedules:
             # Get schedule metadata
@@ -162,14 +923,29 @@ class VetaManager(manager.SchedulerDependentManager):
 
             # Get last backup for schedule
             last_backup = self._last_backup(backups, schedule_uuid)
+            tolerance = self._schedule_tolerance(schedule)
 
             # If the last backup is current,
-            if self._backup_is_current(last_backup, now, frequency):
-                # Skip this schedule
+            if self._backup_is_current(last_backup, now, frequency, anchor,
+                                       tolerance):
+                # Skip this schedule, unless it can join a backup
+                upcoming.append((schedule_uuid,
+                                 self._backup_due_at(last_backup, frequency,
+                                                     anchor, tolerance),
+                                 tolerance))
+                continue
+            # Else if nothing could have changed since the most recent
+            # backup, and the schedule doesn't need another one,
+            elif self._schedule_only_changed(schedule) and \
+                    self._instance_unchanged(context, instance, most_recent):
+                # The most recent backup will do
+                if most_recent is not last_backup:
+                    self._update_backup_satisfies(context, most_recent,
+                                                  [schedule_uuid])
                 continue
             # Else if the most recent backup will do,
             elif self._backup_will_satisfy(most_recent, last_backup,
-                                           now, frequency):
+                                           now, frequency, anchor):
                 # Update the backup metadata
                 self._update_backup_satisfies(context, most_recent,
                                               [schedule_uuid])
@@ -178,11 +954,78 @@ class VetaManager(manager.SchedulerDependentManager):
                 continue
             # Else schedule a backup
             backups_needed.append(schedule_uuid)
+            staleness = max(staleness,
+                            self._backup_staleness(last_backup, now,
+                                                   frequency))
+            min_frequency = min(min_frequency or frequency, frequency)
+            if last_backup:
+                schedule_due_at = self._backup_due_at(last_backup, frequency,
+                                                      anchor, tolerance)
+            else:
+                # Due since the schedule was set up, which (unlike the
+                # current time) doesn't change across retries.
+                if changed_at is None:
+                    changed_at = self._schedule_changed_at(context, instance)
+                schedule_due_at = changed_at
+            due_at = min(due_at or schedule_due_at, schedule_due_at)
 
         # If we need to perform a backup,
         if len(backups_needed) > 0:
-            # Do it
-            self._create_backup(context, instance, backups_needed, now)
+            # Identify it by the schedules that are due and when, which
+            # stay the same until it's taken.
+            key = utils.backup_key(instance['uuid'], backups_needed, due_at)
+
+            # Take it for the schedules coming due shortly as well
+            for (schedule_uuid, schedule_due_at, tolerance) in upcoming:
+                if timeutils.delta_seconds(now, schedule_due_at) <= tolerance:
+                    backups_needed.append(schedule_uuid)
+
+            # Let the caller schedule it
+            return scheduler.PendingBackup(instance, backups_needed,
+                                           staleness, min_frequency, key)
+        return None
+
+    def _schedule_changed_at(self, context, instance):
+        """ Returns when the instance's schedule last changed, or when the
+            instance was created if that isn't known """
+        changed_at = self.driver.instance_backup_schedule_changed_at(
+            context, instance['uuid'])
+        self._journal.changed_at(instance['uuid'], changed_at)
+        return changed_at or instance['created_at']
+
+    def _instance_is_quiescent(self, instance):
+        return instance['vm_state'] in QUIESCENT_VM_STATES and \
+            instance['power_state'] != power_state.RUNNING and \
+            instance['task_state'] is None
+
+    def _instance_unchanged(self, context, instance, backup):
+        """ Returns whether the instance can't have changed since the
+            given backup was taken """
+        if not backup or backup['status'] != 'active':
+            return False
+        # The instance must have been quiescent all along.
+        if backup.get(meta.BACKUP_VM_STATE_KEY) not in QUIESCENT_VM_STATES \
+                or not self._instance_is_quiescent(instance):
+            return False
+        (ts, __, __) = self._backup_metadata_get(backup)
+        if instance['launched_at'] and instance['launched_at'] > ts:
+            return False
+
+        # Taking the backup updates the instance too, so rather than its
+        # last update, look for actions (starting it, say) since. Backup
+        # times are rounded to the nearest minute.
+        since = ts - datetime.timedelta(seconds=30)
+        acted_on = self.driver.instance_acted_on_since(context,
+                                                       instance['uuid'], since)
+        self._journal.acted_on(instance['uuid'], acted_on)
+        return not acted_on
+
+    def _backup_staleness(self, backup, now, frequency):
+        # A schedule without any backup yet is simply due
+        if not backup:
+            return 1.0
+        (ts, __, __) = self._backup_metadata_get(backup)
+        return timeutils.delta_seconds(ts, now) / float(frequency)
 
     def _last_backup(self, backups, schedule_uuid=None):
         for backup in backups:
@@ -192,7 +1035,13 @@ class VetaManager(manager.SchedulerDependentManager):
 
         return None
 
-    def _backup_is_current(self, backup, now, frequency):
+    def _schedule_anchor(self, instance):
+        if not CONF.veta_align_schedules:
+            return None
+        return utils.schedule_anchor(instance['uuid'])
+
+    def _backup_is_current(self, backup, now, frequency, anchor=None,
+                           tolerance=0):
         # If the backup doesn't exist, it's not current :)
         if not backup:
             return False
@@ -202,14 +1051,29 @@ class VetaManager(manager.SchedulerDependentManager):
 
         # Is the timestamp within the range?
         delta = timeutils.delta_seconds(ts, now)
-        return delta < frequency
+        if anchor is None:
+            return delta < frequency
+
+        # With aligned schedules, a backup is current until the end of its
+        # slot, where backups taken early (within the tolerance) count
+        # for the next slot. Backups taken late in their slot (e.g. when
+        # first aligning) stay current for at least half a period though.
+        slot_start = utils.slot_start(now, frequency, anchor)
+        return ts >= slot_start - datetime.timedelta(seconds=tolerance) or \
+            delta < frequency / 2
 
     def _backup_will_satisfy(self, most_recent, last_backup, now,
-                             frequency, fudge_factor=0.04):
+                             frequency, anchor=None, fudge_factor=0.04):
         # If the backup doesn't exist, it's won't satisfy
         if not most_recent:
             return False
 
+        # With aligned schedules, any backup taken in the current slot
+        # will do.
+        if anchor is not None:
+            (mr_ts, __, __) = self._backup_metadata_get(most_recent)
+            return mr_ts >= utils.slot_start(now, frequency, anchor)
+
         # Get backup metadata and time since backup
         (mr_ts, __, __) = self._backup_metadata_get(most_recent)
         mr_delta = timeutils.delta_seconds(mr_ts, now)
@@ -239,31 +1103,82 @@ class VetaManager(manager.SchedulerDependentManager):
             backup.get(meta.BACKUP_SATISFIES_KEY, '[]'))
         return (backup_ts, backup_for, satisfies)
 
+    def _schedule_tolerance(self, schedule):
+        """ Returns how early (in seconds) the schedule's backups may be
+            taken, to coalesce them with other backups """
+        tolerance = schedule.get(meta.SCHEDULE_TOLERANCE_KEY)
+        if tolerance is None:
+            tolerance = schedule[meta.SCHEDULE_FREQUENCY_KEY] * \
+                            CONF.veta_coalesce_tolerance
+        return min(tolerance, CONF.veta_coalesce_window)
+
+    def _schedule_only_changed(self, schedule):
+        return bool(schedule.get(meta.SCHEDULE_ONLY_CHANGED_KEY))
+
     def _schedule_metadata_get(self, schedule):
         return (schedule[meta.SCHEDULE_ID_KEY],
                 schedule[meta.SCHEDULE_FREQUENCY_KEY],
                 schedule[meta.SCHEDULE_RETENTION_KEY],
                 schedule[meta.SCHEDULE_ACTIVE_KEY])
 
-    def _create_backup(self, context, instance, backups_needed, ts):
+    def _backup_request(self, instance, backups_needed, ts, key=None):
+        """ Returns the (instance, name, metadata) of a new backup """
         backup_ts = timeutils.strtime(at=ts)
         backup_name = "%s-backup-%s" % (instance['display_name'],
                                         backup_ts)
         metadata = {
             meta.BACKUP_AT_KEY : backup_ts,
             meta.BACKUP_FOR_KEY : instance['uuid'],
-            meta.BACKUP_SATISFIES_KEY : jsonutils.dumps(backups_needed)
+            meta.BACKUP_SATISFIES_KEY : jsonutils.dumps(backups_needed),
+            meta.BACKUP_VM_STATE_KEY : instance['vm_state']
         }
+        if key:
+            metadata[meta.BACKUP_KEY_KEY] = key
+        return (instance, backup_name, metadata)
+
+    def _create_backups(self, context, backups, ts):
+        """ Creates the given backups at once. Returns the backups
+            created, with None for those that couldn't be. """
+        requests = [self._backup_request(backup.instance, backup.schedules,
+                                         ts, backup.key)
+                    for backup in backups]
+        self._backup_changes += 1
+        try:
+            created = self.driver.create_snapshots(context, requests)
+        except:
+            LOG.exception(_("Couldn't create backups for instances %s, "
+                            "will retry" % \
+                            [backup.instance['uuid'] for backup in backups]))
+            return [None] * len(backups)
+        for (backup, created_backup) in zip(backups, created):
+            if created_backup is None:
+                LOG.error(_("Couldn't create backup for instance %s, "
+                            "will retry" % backup.instance['uuid']))
+            else:
+                LOG.info(_("Created backup with uuid %s" % \
+                           created_backup['uuid']))
+        return created
+
+    def _create_backup(self, context, instance, backups_needed, ts,
+                       key=None):
+        """ Creates a backup of the instance. Returns the backup, or None
+            if it couldn't be created. """
+        (__, backup_name, metadata) = self._backup_request(instance,
+                                                           backups_needed, ts,
+                                                           key)
 
         try:
+            self._backup_changes += 1
             backup = self.driver.create_snapshot(context, instance,
                                                  name=backup_name,
                                                  metadata=metadata)
             LOG.info(_("Created backup with uuid %s" % backup['uuid']))
+            return backup
         except:
             LOG.exception(
                 _("Couldn't create backup for instance %s, will retry" % \
                     instance['uuid']))
+            return None
 
     def _update_backup_satisfies(self, context, backup, uuids,
                                  clean=False):
@@ -272,34 +1187,106 @@ class VetaManager(manager.SchedulerDependentManager):
             (__, __, old_uuids) = self._backup_metadata_get(backup)
             uuids.extend(old_uuids)
         metadata = {
-            meta.BACKUP_SATISFIES_KEY : jsonutils.dumps(uuids)
+            meta.BACKUP_SATISFIES_KEY : jsonutils.dumps(uuids),
+            # The expiry needs to be recomputed.
+            meta.BACKUP_EXPIRES_VERSION_KEY : ''
         }
+        self._backup_changes += 1
+        self._journal.decision(journal.SATISFY, backup[meta.BACKUP_FOR_KEY],
+                               backup['uuid'], schedules=uuids)
         self.driver.backup_metadata_update(context, backup['uuid'],
                                            metadata)
 
     def _prune_instance_backups(self, context, instance, schedules,
-                                backups, now):
+                                backups, now, keep=None, version=None):
+        """ Discards the given backups that are no longer needed, and
+            yields the others. The backups to keep for a schedule
+            regardless of retention are given as a dictionary of schedule
+            ID to backup UUID.
+
+            Backups are stamped with their expiry, as of the given version
+            of the schedules. Until then, or until the schedules change,
+            they don't need to be evaluated again. """
         # For each backup,
         for backup in backups:
+            # If it is known to be needed still, move on
+            stamped = version is not None and \
+                backup.get(meta.BACKUP_EXPIRES_VERSION_KEY) == version
+            if stamped and backup.get(meta.BACKUP_EXPIRES_AT_KEY):
+                expires_at = self._backup_expires_at_get(backup)
+                if expires_at is None or now < expires_at:
+                    yield backup
+                    continue
+
             # Get backup metadata
             (__, __, satisfies) = self._backup_metadata_get(backup)
 
             # Find schedules that it's needed for
-            needed_by = self._backup_needed_by(backup, schedules, now)
+            needed_by = self._backup_needed_by(backup, schedules, now, keep)
             LOG.debug(_("Backup %s needed by %s" % (backup['uuid'], needed_by)))
 
             # If it is still needed,
             if len(needed_by) > 0:
                 # Update the backup metadata if necessary
+                metadata = {}
                 if needed_by != satisfies:
-                    self._update_backup_satisfies(context, backup,
-                        needed_by, True)
+                    self._backup_changes += 1
+                    metadata[meta.BACKUP_SATISFIES_KEY] = \
+                        jsonutils.dumps(needed_by)
+                    backup.update(metadata)
+                if not stamped and version is not None:
+                    expires_at = self._backup_expires_at(backup, schedules)
+                    metadata[meta.BACKUP_EXPIRES_AT_KEY] = \
+                        expires_at and timeutils.strtime(at=expires_at) or \
+                            meta.BACKUP_NEVER_EXPIRES
+                    metadata[meta.BACKUP_EXPIRES_VERSION_KEY] = version
+                if metadata:
+                    self._journal.decision(journal.UPDATE, instance['uuid'],
+                                           backup['uuid'], metadata=metadata)
+                    self.driver.backup_metadata_update(context,
+                                                       backup['uuid'],
+                                                       metadata)
+                    backup.update(metadata)
+                yield backup
             # Else,
             else:
                 # Discard the backup
                 self._discard_backup(context, backup)
 
-    def _backup_needed_by(self, backup, schedules, now):
+    def _backup_expires_at(self, backup, schedules):
+        """ Returns when the backup is no longer needed by the given
+            schedules (as far as retention goes), or None if it's needed
+            as long as they don't change. See _backup_needed_by. """
+        (ts, __, satisfies) = self._backup_metadata_get(backup)
+        expires_at = ts
+        for schedule in schedules:
+            (schedule_id, __, retention, active) = \
+                self._schedule_metadata_get(schedule)
+            if schedule_id in satisfies:
+                if active == False:
+                    return None
+                expires_at = max(expires_at,
+                                 ts + datetime.timedelta(seconds=retention))
+        return expires_at
+
+    def _backup_expires_at_get(self, backup):
+        """ Returns the expiry the backup is stamped with, None if it
+            never expires (or isn't stamped) """
+        expires_at = backup.get(meta.BACKUP_EXPIRES_AT_KEY)
+        if not expires_at or expires_at == meta.BACKUP_NEVER_EXPIRES:
+            return None
+        return timeutils.parse_strtime(expires_at)
+
+    def _new_backup_expires_at(self, schedules, pending, now):
+        """ Returns when a backup taken now for the pending backup's
+            schedules will expire """
+        retention = max([schedule[meta.SCHEDULE_RETENTION_KEY] \
+                         for schedule in schedules \
+                         if schedule[meta.SCHEDULE_ID_KEY] in \
+                             pending.schedules] or [0])
+        return now + datetime.timedelta(seconds=retention)
+
+    def _backup_needed_by(self, backup, schedules, now, keep=None):
         # List of schedules needing this backup
         needed_by = []
 
@@ -316,19 +1303,37 @@ class VetaManager(manager.SchedulerDependentManager):
             if schedule_id in satisfies:
                 # If this schedule is inactive, or if
                 # this backup is within the retention period,
+                # or if it must be kept regardless,
                 delta = timeutils.delta_seconds(ts, now)
-                if active == False or delta < retention:
+                if active == False or delta < retention or \
+                        (keep and keep.get(schedule_id) == backup['uuid']):
                     # Add the schedule to the list
                     needed_by.append(schedule_id)
 
         # Return list
         return needed_by
 
+    def _discard_backups(self, context, backups):
+        backup_uuids = [backup['uuid'] for backup in backups]
+        for backup in backups:
+            self._journal.decision(journal.DISCARD,
+                                   backup[meta.BACKUP_FOR_KEY], backup['uuid'])
+        self._backup_changes += 1
+        failed = self.driver.discard_snapshots(context, backup_uuids)
+        if failed:
+            self._discard_failures += 1
+        LOG.info(_("Discarded failed backups with uuids %s" % \
+                   [uuid for uuid in backup_uuids if uuid not in failed]))
+
     def _discard_backup(self, context, backup):
         backup_uuid = backup['uuid']
+        self._journal.decision(journal.DISCARD, backup[meta.BACKUP_FOR_KEY],
+                               backup_uuid)
         try:
+            self._backup_changes += 1
             self.driver.discard_snapshot(context, backup_uuid)
             LOG.info(_("Discarded backup with uuid %s" % backup_uuid))
         except:
+            self._discard_failures += 1
             LOG.exception(_("Cannot discard backup with uuid %s, will retry" % \
                           backup_uuid))
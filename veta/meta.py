@@ -29,6 +29,14 @@ BACKUP_ACTIVE_KEY = _meta_key(_BACKUP_ACTIVE_KEY)
 _BACKUP_SCHEDULE_KEY = "backup_sched"
 BACKUP_SCHEDULE_KEY = _meta_key(_BACKUP_SCHEDULE_KEY)
 
+# Backup schedule version, bumped on every schedule update
+_BACKUP_SCHEDULE_VERSION_KEY = "backup_sched_ver"
+BACKUP_SCHEDULE_VERSION_KEY = _meta_key(_BACKUP_SCHEDULE_VERSION_KEY)
+
+# Digest of the instance's backups, maintained by the manager
+_BACKUP_DIGEST_KEY = "backup_digest"
+BACKUP_DIGEST_KEY = _meta_key(_BACKUP_DIGEST_KEY)
+
 # Schedule item keys
 # Note: the shorter these are, the more schedule items
 # we can fit.
@@ -36,10 +44,19 @@ SCHEDULE_ID_KEY = "i"
 SCHEDULE_FREQUENCY_KEY = "f"
 SCHEDULE_RETENTION_KEY = "r"
 SCHEDULE_ACTIVE_KEY = "a"
+# Only back up if the instance may have changed (omitted if not)
+SCHEDULE_ONLY_CHANGED_KEY = "c"
+# How early (in seconds) a backup may be taken (omitted for the default)
+SCHEDULE_TOLERANCE_KEY = "t"
 
 # From empirical testing
 MAX_SCHEDULE_ITEMS = 5
 
+# Schedules are stored as (compact) JSON in a single metadata value, which
+# can be no longer than this. Optional item keys count against it, so
+# schedules using them may fit fewer items.
+MAX_SCHEDULE_LENGTH = 255
+
 # Backup time
 _BACKUP_AT_KEY = "backup_at"
 BACKUP_AT_KEY = _meta_key(_BACKUP_AT_KEY)
@@ -51,3 +68,38 @@ BACKUP_FOR_KEY = _meta_key(_BACKUP_FOR_KEY)
 # Backup schedules satisfied
 _BACKUP_SATISFIES_KEY = "backup_ids"
 BACKUP_SATISFIES_KEY = _meta_key(_BACKUP_SATISFIES_KEY)
+
+# State of the instance when the backup was taken
+_BACKUP_VM_STATE_KEY = "backup_vm_state"
+BACKUP_VM_STATE_KEY = _meta_key(_BACKUP_VM_STATE_KEY)
+
+# When the backup is no longer needed by its schedules ("never" if it is
+# needed as long as they don't change), and the schedule version this was
+# computed at
+_BACKUP_EXPIRES_AT_KEY = "backup_expires_at"
+BACKUP_EXPIRES_AT_KEY = _meta_key(_BACKUP_EXPIRES_AT_KEY)
+_BACKUP_EXPIRES_VERSION_KEY = "backup_expires_ver"
+BACKUP_EXPIRES_VERSION_KEY = _meta_key(_BACKUP_EXPIRES_VERSION_KEY)
+BACKUP_NEVER_EXPIRES = "never"
+
+# Identifies the backup planned for an instance's schedules and due slot,
+# so that retries don't take it twice
+_BACKUP_KEY_KEY = "backup_key"
+BACKUP_KEY_KEY = _meta_key(_BACKUP_KEY_KEY)
+
+# Backup policy referenced by an instance
+_BACKUP_POLICY_KEY = "backup_policy"
+BACKUP_POLICY_KEY = _meta_key(_BACKUP_POLICY_KEY)
+
+# Shared backup policies are stored once, as metadata on a dedicated
+# (host-less) aggregate. Each policy uses two keys, holding its schedule
+# and its name respectively, to stay within the metadata value size.
+POLICY_AGGREGATE_NAME = "veta-policies"
+POLICY_SCHEDULE_KEY_PREFIX = _meta_key("policy:")
+POLICY_NAME_KEY_PREFIX = _meta_key("policy_name:")
+POLICY_VERSION_KEY_PREFIX = _meta_key("policy_ver:")
+
+# Policy keys
+POLICY_ID_KEY = "id"
+POLICY_NAME_KEY = "name"
+POLICY_SCHEDULE_KEY = "schedule"
@@ -0,0 +1,186 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+On-demand profiling of the manager's periodic tasks.
+
+The profiler is armed for a number of cycles, on start (see
+veta_profile_cycles), when the manager receives SIGUSR2, or after a cycle
+took longer than veta_slow_cycle_threshold. Each profiled cycle is saved to
+a timestamped file, which can be loaded with pstats, and a summary of the
+functions it spent the most time in is logged. Time spent waiting for locks
+(see synchronized) is neither profiled nor counted toward the cycle.
+"""
+
+import cProfile
+import functools
+import os
+import pstats
+import tempfile
+import time
+from StringIO import StringIO
+
+from eventlet import greenthread
+
+from nova.openstack.common import log as logging
+from nova.openstack.common import timeutils
+from nova.openstack.common.gettextutils import _
+
+from oslo.config import cfg
+
+LOG = logging.getLogger('nova.veta.profiler')
+CONF = cfg.CONF
+
+profiler_opts = [
+    cfg.IntOpt('veta_profile_cycles',
+               default=0,
+               help='The number of manager cycles to profile on start.'),
+    cfg.IntOpt('veta_profile_signal_cycles',
+               default=3,
+               help='The number of manager cycles to profile when the'
+                    ' manager receives SIGUSR2.'),
+    cfg.IntOpt('veta_slow_cycle_threshold',
+               default=0,
+               help='Profile the next cycle after one takes longer than'
+                    ' this many seconds. 0 disables this.'),
+    cfg.StrOpt('veta_profile_dir',
+               default=None,
+               help='Directory to save profiles to (the temporary'
+                    ' directory by default).'),
+    cfg.IntOpt('veta_profile_top',
+               default=20,
+               help='The number of functions logged for each profile.')]
+CONF.register_opts(profiler_opts)
+
+# Cycles left to profile, and cycles to profile requested by signal
+_armed = None
+_signalled = 0
+
+# The cycle running, if any
+_cycle = None
+
+class _Cycle(object):
+    """ A cycle being timed, and possibly profiled, in the greenthread
+        running it """
+    def __init__(self, profile=None):
+        self.thread = greenthread.getcurrent()
+        self.profile = profile
+        self.waited = 0.0
+        self.wait_started = None
+
+def arm(cycles):
+    """ Profiles the next given number of cycles """
+    global _armed
+    _armed = max(_armed or 0, cycles)
+    LOG.info(_("Profiling the next %d cycles" % _armed))
+
+def handle_signal(signum, frame):
+    """ Arms the profiler on SIGUSR2. This only notes the request, which
+        the next cycle picks up, as logging isn't safe here. """
+    global _signalled
+    _signalled = CONF.veta_profile_signal_cycles
+
+def _current_cycle():
+    if _cycle is not None and greenthread.getcurrent() is _cycle.thread:
+        return _cycle
+    return None
+
+def _wait_started():
+    cycle = _current_cycle()
+    if cycle is not None:
+        if cycle.profile is not None:
+            cycle.profile.disable()
+        cycle.wait_started = time.time()
+
+def _wait_ended():
+    cycle = _current_cycle()
+    if cycle is not None and cycle.wait_started is not None:
+        cycle.waited += time.time() - cycle.wait_started
+        cycle.wait_started = None
+        if cycle.profile is not None:
+            cycle.profile.enable()
+
+def synchronized(lock):
+    """ Returns a decorator holding the given lock (a decorator such as
+        nova.utils.synchronized(name)), that doesn't count the wait for the
+        lock toward the cycle running """
+    def wrap(func):
+        def held(*args, **kwargs):
+            _wait_ended()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _wait_started()
+        locked = lock(held)
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            _wait_started()
+            try:
+                return locked(*args, **kwargs)
+            finally:
+                _wait_ended()
+        return inner
+    return wrap
+
+def _profile_path(name):
+    directory = CONF.veta_profile_dir or tempfile.gettempdir()
+    return os.path.join(directory, "veta-%s-%s.prof" % \
+        (name, timeutils.strtime(fmt="%Y%m%dT%H%M%S")))
+
+def _summary(profile):
+    stream = StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats('cumulative').print_stats(CONF.veta_profile_top)
+    return stream.getvalue()
+
+def profiled(name, func, *args, **kwargs):
+    """ Calls func, profiling the call if armed """
+    global _armed, _signalled, _cycle
+    if _armed is None:
+        _armed = CONF.veta_profile_cycles
+    if _signalled:
+        (cycles, _signalled) = (_signalled, 0)
+        LOG.info(_("Received SIGUSR2"))
+        arm(cycles)
+
+    if _armed <= 0:
+        cycle = _cycle = _Cycle()
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _cycle = None
+            elapsed = time.time() - started - cycle.waited
+            if CONF.veta_slow_cycle_threshold and \
+                    elapsed > CONF.veta_slow_cycle_threshold:
+                LOG.warn(_("The %s cycle took %.1f seconds, profiling "
+                           "the next one" % (name, elapsed)))
+                arm(1)
+
+    _armed -= 1
+    cycle = _cycle = _Cycle(cProfile.Profile())
+    try:
+        return cycle.profile.runcall(func, *args, **kwargs)
+    finally:
+        _cycle = None
+        path = _profile_path(name)
+        try:
+            cycle.profile.dump_stats(path)
+            LOG.info(_("Profile of the %s cycle saved to %s (%.1f seconds "
+                       "spent waiting for locks excluded):\n%s" % \
+                       (name, path, cycle.waited, _summary(cycle.profile))))
+        except:
+            LOG.exception(_("Unable to save the profile to %s" % path))
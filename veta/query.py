@@ -0,0 +1,115 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Lightweight queries for the instances the manager schedules backups of.
+
+Rather than full instance objects, along with all their joined
+relationships, these select only the columns and metadata keys the manager
+looks at, as :py:class:`InstanceRecord` objects. The snapshot drivers load
+the full instance when they need it.
+"""
+
+from nova import exception
+from nova.db.sqlalchemy import api as db_api
+from nova.db.sqlalchemy import models
+
+from . import meta
+from . import utils
+
+# Instance columns selected
+INSTANCE_COLUMNS = ('uuid', 'display_name', 'user_id', 'project_id', 'host',
+                    'vm_state', 'power_state', 'task_state', 'created_at',
+                    'launched_at', 'updated_at')
+
+# Instance metadata keys selected
+METADATA_KEYS = (meta.BACKUP_ACTIVE_KEY, meta.BACKUP_DIGEST_KEY)
+
+# How many instances are looked up at a time
+BATCH_SIZE = 500
+
+class InstanceRecord(object):
+    """ The columns of an instance the manager needs, and the Veta keys of
+        its metadata (as a dictionary). Fields can be accessed as items,
+        like those of an instance. """
+    __slots__ = INSTANCE_COLUMNS + ('metadata',)
+
+    def __init__(self, row, metadata):
+        for (column, value) in zip(INSTANCE_COLUMNS, row):
+            setattr(self, column, value)
+        self.metadata = metadata
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+def _instance_metadata(context, instance_uuids=None):
+    """ Returns the Veta metadata of the given instances (or all of them)
+        as a dictionary of instance UUID to metadata """
+    query = db_api.model_query(context,
+                               models.InstanceMetadata.instance_uuid,
+                               models.InstanceMetadata.key,
+                               models.InstanceMetadata.value,
+                               base_model=models.InstanceMetadata,
+                               read_deleted="no").\
+                filter(models.InstanceMetadata.key.in_(METADATA_KEYS))
+    if instance_uuids is not None:
+        query = query.filter(
+            models.InstanceMetadata.instance_uuid.in_(instance_uuids))
+
+    metadata = {}
+    for (instance_uuid, key, value) in query.all():
+        metadata.setdefault(instance_uuid, {})[key] = value
+    return metadata
+
+def _instance_records(context, metadata):
+    """ Returns the records of the instances in the given metadata (see
+        _instance_metadata) """
+    columns = [getattr(models.Instance, column) \
+               for column in INSTANCE_COLUMNS]
+    instance_uuids = metadata.keys()
+    records = []
+    for i in range(0, len(instance_uuids), BATCH_SIZE):
+        rows = db_api.model_query(context, *columns,
+                                  base_model=models.Instance,
+                                  read_deleted="no").\
+                    filter(models.Instance.uuid.in_(
+                        instance_uuids[i:i + BATCH_SIZE])).all()
+        for row in rows:
+            records.append(InstanceRecord(row, metadata[row[0]]))
+    return records
+
+def scheduled_instances(context):
+    """ Returns the records of the instances with backups enabled """
+    metadata = _instance_metadata(context)
+    for (instance_uuid, instance_metadata) in metadata.items():
+        if not utils.is_true(instance_metadata.get(meta.BACKUP_ACTIVE_KEY)):
+            del metadata[instance_uuid]
+    return _instance_records(context, metadata)
+
+def instance_get(context, instance_uuid):
+    """ Returns the record of the given instance, or raises
+        InstanceNotFound """
+    metadata = _instance_metadata(context, [instance_uuid])
+    metadata.setdefault(instance_uuid, {})
+    records = _instance_records(context, metadata)
+    if not records:
+        raise exception.InstanceNotFound(instance_id=instance_uuid)
+    return records[0]
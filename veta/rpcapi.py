@@ -0,0 +1,48 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Client side of the Veta manager RPC API."""
+
+from nova.openstack.common.rpc import proxy as rpc_proxy
+
+from oslo.config import cfg
+
+rpcapi_opts = [
+    cfg.StrOpt('veta_topic',
+               default='veta',
+               help='The topic the veta manager listens on.')
+]
+
+CONF = cfg.CONF
+CONF.register_opts(rpcapi_opts)
+
+class VetaAPI(rpc_proxy.RpcProxy):
+    '''Client side of the Veta manager RPC API.
+
+    API version history:
+
+        1.0 - Initial version.
+    '''
+
+    BASE_RPC_API_VERSION = '1.0'
+
+    def __init__(self):
+        super(VetaAPI, self).__init__(
+            topic=CONF.veta_topic,
+            default_version=self.BASE_RPC_API_VERSION)
+
+    def schedules_changed(self, ctxt, instance_uuids):
+        self.cast(ctxt, self.make_msg('schedules_changed',
+                                      instance_uuids=instance_uuids))
@@ -0,0 +1,132 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Ordering of the backups the manager has decided to take.
+
+Each cycle, the manager evaluates the schedules of every instance and
+produces a :py:class:`PendingBackup` for each instance needing a backup.
+The functions here decide which of those are started in the current cycle,
+and in which order.
+"""
+
+import heapq
+
+class PendingBackup(object):
+    """ A backup of an instance, satisfying the given schedules.
+
+        The staleness is how overdue the most overdue of those schedules
+        is, relative to its frequency: a schedule whose last backup is
+        exactly one frequency old has a staleness of 1.0. The frequency is
+        the shortest frequency of those schedules. The key identifies the
+        backup, see utils.backup_key(). """
+    __slots__ = ('instance', 'schedules', 'staleness', 'frequency', 'key')
+
+    def __init__(self, instance, schedules, staleness, frequency, key=None):
+        self.instance = instance
+        self.schedules = schedules
+        self.staleness = staleness
+        self.frequency = frequency
+        self.key = key
+
+def release_catchup(backups, threshold, rate):
+    """ Splits the given backups into those to start now and those to
+        defer to a later cycle.
+
+        Backups that are due on schedule are always started. Backups that
+        are overdue by threshold (as a staleness) or more, such as after
+        an outage of the manager, are caught up at most rate at a time,
+        the most overdue first, and then those with the shortest frequency.
+    """
+    regular = []
+    overdue = []
+    for backup in backups:
+        if backup.staleness >= threshold:
+            overdue.append(backup)
+        else:
+            regular.append(backup)
+    overdue.sort(key=lambda b: (-b.staleness, b.frequency))
+    return (regular + overdue[:rate], overdue[rate:])
+
+def defer_busy(backups, host_loads, max_load, slack):
+    """ Splits the given backups into those to start now and those to
+        defer because their instance's host is busy.
+
+        The host loads map host names to their load (the number of tasks,
+        such as snapshots, in progress), and every backup started counts
+        towards the load of its host. A backup is only deferred while its
+        staleness stays within the slack (as a fraction of its frequency)
+        past its due time, so that busy hosts delay backups but never
+        starve them.
+    """
+    released = []
+    deferred = []
+    for backup in backups:
+        host = backup.instance['host']
+        load = host_loads.get(host)
+        if load is not None and load >= max_load and \
+                backup.staleness < 1.0 + slack:
+            deferred.append(backup)
+            continue
+        released.append(backup)
+        if load is not None:
+            host_loads[host] = load + 1
+    return (released, deferred)
+
+def fair_share(backups, in_progress, capacity, weights, quotas,
+               default_quota=None):
+    """ Splits the given backups into those to start now and those to
+        defer because their tenant (project) has used up its share.
+
+        Backups are started one at a time, each time for the tenant with
+        the fewest snapshots in progress relative to its weight (i.e.
+        weighted fair queuing), and the most overdue backups of each tenant
+        first. The number of snapshots in progress, weights (1.0 unless
+        given) and quotas map projects to their number of snapshots in
+        progress, share, and the most snapshots they may have in progress.
+        The capacity bounds the number of snapshots in progress overall.
+        A capacity or quota of None means no limit.
+    """
+    queues = {}
+    for backup in backups:
+        queues.setdefault(backup.instance['project_id'], []).append(backup)
+
+    in_progress = dict(in_progress)
+    heap = []
+    for (project, queue) in queues.items():
+        # Most overdue last, so it's popped first
+        queue.sort(key=lambda b: (b.staleness, -b.frequency))
+        heapq.heappush(heap, ((in_progress.get(project, 0) + 1) / \
+                                  weights.get(project, 1.0), project))
+
+    running = sum(in_progress.values())
+    released = []
+    while heap and (capacity is None or running < capacity):
+        (__, project) = heapq.heappop(heap)
+        count = in_progress.get(project, 0)
+        quota = quotas.get(project, default_quota)
+        if quota is not None and count >= quota:
+            # The rest of this tenant's backups wait
+            continue
+        queue = queues[project]
+        released.append(queue.pop())
+        in_progress[project] = count + 1
+        running += 1
+        if queue:
+            heapq.heappush(heap, ((count + 2) / weights.get(project, 1.0),
+                                  project))
+
+    deferred = [backup for queue in queues.values() for backup in queue]
+    return (released, deferred)
@@ -0,0 +1,78 @@
+# Copyright 2013 Gridcentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from nova import exception
+from nova import manager as nova_manager
+
+from oslo.config import cfg
+
+from veta import manager
+
+CONF = cfg.CONF
+
+class FakeConnection(object):
+    """ An RPC connection recording the consumer pools joined """
+    def __init__(self):
+        self.pools = []
+
+    def join_consumer_pool(self, callback, pool_name, topic,
+                           exchange_name):
+        self.pools.append((pool_name, topic, exchange_name))
+
+class NotificationConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.hooked = []
+        self.base_hook = nova_manager.Manager.pre_start_hook
+        def pre_start_hook(manager, **kwargs):
+            self.hooked.append(kwargs)
+        nova_manager.Manager.pre_start_hook = pre_start_hook
+        CONF.set_override('veta_notifications', True)
+        CONF.set_override('veta_notification_topics',
+                          ['notifications.info', 'veta'])
+        CONF.set_override('veta_notification_exchanges', ['nova', 'glance'])
+        # The hook doesn't need anything set up by the constructor.
+        self.manager = manager.VetaManager.__new__(manager.VetaManager)
+
+    def tearDown(self):
+        nova_manager.Manager.pre_start_hook = self.base_hook
+        CONF.clear_override('veta_notifications')
+        CONF.clear_override('veta_notification_topics')
+        CONF.clear_override('veta_notification_exchanges')
+
+    def test_notifications_have_their_own_queue(self):
+        connection = FakeConnection()
+        self.manager.pre_start_hook(rpc_connection=connection)
+        self.assertEqual(connection.pools,
+                         [('veta.notifications', 'notifications.info',
+                           'nova'),
+                          ('veta.notifications', 'notifications.info',
+                           'glance')])
+        for (pool_name, __, __) in connection.pools:
+            self.assertNotEqual(pool_name, CONF.veta_topic)
+
+    def test_connection_reaches_base_hook(self):
+        connection = FakeConnection()
+        self.manager.pre_start_hook(rpc_connection=connection)
+        self.assertEqual(self.hooked, [{ 'rpc_connection' : connection }])
+
+    def test_pool_named_after_topic_rejected(self):
+        CONF.set_override('veta_notification_pool', CONF.veta_topic)
+        try:
+            self.assertRaises(exception.NovaException, self.manager.pre_start_hook,
+                              rpc_connection=FakeConnection())
+        finally:
+            CONF.clear_override('veta_notification_pool')
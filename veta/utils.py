@@ -13,11 +13,46 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import hashlib
+
 from nova.openstack.common import jsonutils
 from nova.openstack.common import timeutils
 
 from . import meta
 
+# Backup states, see backup_state
+BACKUP_ACTIVE = 'active'
+BACKUP_PENDING = 'pending'
+BACKUP_FAILED = 'failed'
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Image statuses of snapshots still being taken
+_IN_PROGRESS_STATUSES = ('queued', 'saving')
+
+def schedule_dumps(schedule):
+    """ Returns the schedule serialized as compactly as possible, for
+        storing in a metadata value (see meta.MAX_SCHEDULE_LENGTH) """
+    return jsonutils.dumps(schedule, separators=(',', ':'))
+
+def is_true(value):
+    """ Returns whether the metadata value is true """
+    return str(value).lower() in ('true', '1', 'yes')
+
+def backup_state(backup, now, timeout):
+    """ Returns whether the backup is usable (BACKUP_ACTIVE), still being
+        taken (BACKUP_PENDING) or failed or stuck (BACKUP_FAILED). Backups
+        in progress for longer than the timeout are considered stuck. """
+    status = (backup.get('status') or 'active').lower()
+    if status == 'active':
+        return BACKUP_ACTIVE
+    if status in _IN_PROGRESS_STATUSES:
+        (backup_ts, __, __) = parse_backup(backup)
+        if timeutils.delta_seconds(backup_ts, now) < timeout:
+            return BACKUP_PENDING
+    return BACKUP_FAILED
+
 def parse_backup(backup):
     backup_ts = timeutils.parse_strtime(
                     backup.get(meta.BACKUP_AT_KEY))
@@ -26,6 +61,10 @@ def parse_backup(backup):
         backup.get(meta.BACKUP_SATISFIES_KEY, '[]'))
     return (backup_ts, backup_for, satisfies)
 
+def project_backup(backup, fields):
+    """ Returns the backup restricted to the given fields """
+    return dict((field, backup[field]) for field in fields if field in backup)
+
 def parse_schedule(schedule):
     return (schedule[meta.SCHEDULE_ID_KEY],
             schedule[meta.SCHEDULE_FREQUENCY_KEY],
@@ -44,3 +83,49 @@ def schedule_has_conflict(schedule, frequency, retention):
                 item[meta.SCHEDULE_RETENTION_KEY] == retention:
             return item
     return None
+
+class BackupsDigest(object):
+    """ Computes the digest of backups one backup at a time, so that
+        backups can be streamed, see backups_digest() """
+    def __init__(self, salt=''):
+        self._digest = hashlib.sha1(salt)
+
+    def update(self, backup):
+        self._digest.update("%s:%s:%s;" % (backup['uuid'], backup['status'],
+                                           backup.get(meta.BACKUP_SATISFIES_KEY)))
+
+    def hexdigest(self):
+        return self._digest.hexdigest()[:16]
+
+def schedule_anchor(instance_uuid):
+    """ Returns the anchor of the instance's schedules, as an offset in
+        seconds (a whole number of minutes within a day). Anchors are
+        spread over the day so that instances aren't all backed up at once.
+    """
+    return (int(hashlib.sha1(instance_uuid).hexdigest()[:8], 16) % 1440) * 60
+
+def slot_start(ts, frequency, anchor):
+    """ Returns the start of the slot containing ts, for slots of the
+        given frequency (in seconds) aligned on the given anchor """
+    elapsed = int(timeutils.delta_seconds(_EPOCH, ts)) - anchor
+    return ts - datetime.timedelta(seconds=elapsed % frequency)
+
+def backup_key(instance_uuid, schedule_ids, due_at):
+    """ Returns the key identifying the backup of the instance for the
+        given schedules, due at the given time """
+    return hashlib.sha1(jsonutils.dumps([instance_uuid,
+                                         sorted(schedule_ids),
+                                         timeutils.strtime(at=due_at)])
+                        ).hexdigest()[:16]
+
+def backups_digest(backups, salt=''):
+    """ Returns a short digest identifying the state of the given backups """
+    digest = BackupsDigest(salt)
+    for backup in backups:
+        digest.update(backup)
+    return digest.hexdigest()
+
+def params_digest(params):
+    """ Returns a short digest identifying the given request parameters """
+    return hashlib.sha1(
+        jsonutils.dumps(params or {}, sort_keys=True)).hexdigest()[:8]